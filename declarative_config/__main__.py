@@ -0,0 +1,6 @@
+"""Runs declarative config with python -m declarative_config."""
+import sys
+from declarative_config.declarative_config import main
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
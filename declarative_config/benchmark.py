@@ -0,0 +1,307 @@
+"""Benchmarks for declarative config on synthetic product listings.
+
+Listings of configurable size are generated across the arches in
+tree_ids_for_given_arches, and each phase of handling them is timed: parse,
+validate, reconcile and generate in memory and, with --backend, insert, no-op
+re-insert, delete-heavy update and generate against a local PostgreSQL or the
+in-memory backend. The results are printed as JSON so regressions can be
+tracked. The DB phases delete the products they create, so the postgres
+backend is refused when PROD_DB selects the production database.
+
+Run it with python -m declarative_config.benchmark.
+"""
+from argparse import ArgumentParser, Namespace
+import io
+import json
+import logging
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import yaml
+from declarative_config.db import DB_BACKENDS, connect, tree_ids_for_given_arches
+from declarative_config.generate import (
+    YamlDumper,
+    generate_yaml,
+    listing_header,
+    package_blocks,
+    write_listing_blocks,
+)
+from declarative_config.insert import insert_listing
+from declarative_config.listings import (
+    VALIDATOR_ENGINES,
+    YamlLoader,
+    load_validator,
+    parse_listing,
+    validate_listing,
+)
+from declarative_config.reconcile import expand_package_listings, reconcile_overrides
+
+ARCHES = sorted(tree_ids_for_given_arches)
+
+# The multilib pairings found in real listings, package arch first.
+MULTILIB_PAIRS = [
+    ("i386", "x86_64"),
+    ("ppc", "ppc64"),
+    ("s390", "s390x"),
+    ("i386", "ia64"),
+]
+
+# The label of every synthetic product, so leftovers are easy to find.
+BENCHMARK_LABEL = "benchmark"
+
+
+def synthetic_listing(packages, seed=0, variant=None):
+    """Generates the yaml data of a valid product listing with the given number
+    of packages. The same size and seed always give the same listing."""
+    rng = random.Random(seed)
+    listing = {}
+    for index in range(packages):
+        offerings = {}
+        arches = sorted(rng.sample(ARCHES, rng.randint(1, len(ARCHES))))
+        if rng.random() < 0.8:
+            offerings["arch"] = arches
+        if rng.random() < 0.9:
+            offerings["src"] = arches
+        if not offerings or rng.random() < 0.2:
+            offerings["noarch"] = arches
+        if rng.random() < 0.1:
+            offerings["multilib"] = [
+                {pkg_arch: prod_arch}
+                for pkg_arch, prod_arch in rng.sample(MULTILIB_PAIRS, 2)
+            ]
+        listing["pkg-{0:06d}".format(index)] = offerings
+
+    return {
+        "product_name": BENCHMARK_LABEL,
+        "version": 1.0,
+        "variant": variant or "Bench-{0}".format(packages),
+        "allow_source_only": False,
+        "packages": listing,
+    }
+
+
+def trimmed_listing(yaml_data, keep_every=10):
+    """Returns a copy of a listing keeping only every keep_every-th package, to
+    time an update that mostly deletes."""
+    trimmed = dict(yaml_data)
+    trimmed["packages"] = {
+        pkg_name: offerings
+        for index, (pkg_name, offerings) in enumerate(yaml_data["packages"].items())
+        if index % keep_every == 0
+    }
+    return trimmed
+
+
+def time_phase(run, repeat, setup=None):
+    """Runs a phase repeat times, after setup if given, and returns the fastest
+    wall time in seconds."""
+    timings = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        started = time.perf_counter()
+        run()
+        timings.append(time.perf_counter() - started)
+    return min(timings)
+
+
+def bench_in_memory(yaml_data, options):
+    """Times the phases that don't touch the DB. Returns a dictionary from
+    phase name to seconds."""
+    content = yaml.dump(yaml_data, Dumper=YamlDumper, sort_keys=False).encode("utf-8")
+    validator = load_validator(options.schemapath, options.validator)
+    desired = expand_package_listings(yaml_data["packages"])
+    # The state in the DB differs from the listing by a tenth of the packages.
+    current = expand_package_listings(trimmed_listing(yaml_data)["packages"])
+    current |= {(name + "-old", *rest) for name, *rest in list(current)[::10]}
+    product = (0, yaml_data["product_name"], "1.0", yaml_data["variant"], False)
+    rows = sorted(desired)
+
+    def reconcile():
+        reconcile_overrides(expand_package_listings(yaml_data["packages"]), current)
+
+    def generate():
+        write_listing_blocks(
+            listing_header(product), package_blocks(rows), io.StringIO()
+        )
+
+    return {
+        "parse": time_phase(lambda: parse_listing(content), options.repeat),
+        "validate": time_phase(
+            lambda: validate_listing(yaml_data, validator), options.repeat
+        ),
+        "reconcile": time_phase(reconcile, options.repeat),
+        "generate": time_phase(generate, options.repeat),
+    }
+
+
+def drop_product(yaml_data, my_db):
+    """Removes a synthetic product and everything referencing it from the DB."""
+    prod_ids = """SELECT id FROM products
+    WHERE label = '{0}' and version = '{1}' and variant = '{2}'""".format(
+        yaml_data["product_name"], yaml_data["version"], yaml_data["variant"]
+    )
+    for table, column in (
+        ("overrides", "product"),
+        ("tree_product_map", "product_id"),
+        ("listing_fingerprints", "product_id"),
+        ("products", "id"),
+    ):
+        my_db.query(
+            "DELETE FROM {0} WHERE {1} IN ({2})".format(table, column, prod_ids)
+        )
+
+
+def bench_database(yaml_data, options, my_db):
+    """Times the phases that write to or read from the DB, leaving no synthetic
+    product behind. Returns a dictionary from phase name to seconds."""
+    trimmed = trimmed_listing(yaml_data)
+
+    def insert(data, force=False):
+        insert_listing(data, True, my_db, True, force)
+
+    def generate():
+        with tempfile.TemporaryDirectory() as directory:
+            generate_yaml(
+                Namespace(
+                    filepath=os.path.join(directory, "listing.yaml"),
+                    product=yaml_data["product_name"],
+                    version=yaml_data["version"],
+                    variant=yaml_data["variant"],
+                    batch_size=5000,
+                    canonical=True,
+                    all=False,
+                )
+            )
+
+    try:
+        results = {
+            "insert": time_phase(
+                lambda: insert(yaml_data),
+                options.repeat,
+                setup=lambda: drop_product(yaml_data, my_db),
+            ),
+            "noop_insert": time_phase(lambda: insert(yaml_data), options.repeat),
+            "noop_reconcile": time_phase(
+                lambda: insert(yaml_data, force=True), options.repeat
+            ),
+            "generate_from_db": time_phase(generate, options.repeat),
+            "delete_heavy": time_phase(
+                lambda: insert(trimmed, force=True),
+                options.repeat,
+                setup=lambda: insert(yaml_data, force=True),
+            ),
+        }
+    finally:
+        drop_product(yaml_data, my_db)
+    return results
+
+
+def run_benchmarks(options):
+    """Runs every phase for every listing size. Returns the report."""
+    report = {
+        "python": platform.python_version(),
+        "libyaml": YamlLoader is not yaml.SafeLoader,
+        "backend": options.backend,
+        "validator": options.validator,
+        "repeat": options.repeat,
+        "seed": options.seed,
+        "sizes": {},
+    }
+
+    my_db = None
+    if options.backend != "none":
+        # generate opens its own connection, which has to use the same backend.
+        os.environ["DB_BACKEND"] = options.backend
+        my_db = connect(options.db_config)
+    try:
+        for size in options.sizes:
+            yaml_data = synthetic_listing(size, options.seed)
+            phases = bench_in_memory(yaml_data, options)
+            if my_db is not None:
+                phases.update(bench_database(yaml_data, options, my_db))
+            report["sizes"][str(size)] = {
+                "overrides": len(expand_package_listings(yaml_data["packages"])),
+                "seconds": phases,
+            }
+    finally:
+        if my_db is not None:
+            my_db.close()
+    return report
+
+
+def main(args):
+    """Runs the benchmarks and prints the report as JSON, or writes it to the
+    file given with --output."""
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--sizes",
+        help="Comma separated numbers of packages per listing.",
+        type=lambda sizes: [int(size) for size in sizes.split(",")],
+        default=[10, 1000, 50000],
+        metavar="",
+    )
+    parser.add_argument(
+        "--backend",
+        help="Where to run the DB phases. 'none' only runs the in-memory phases.",
+        choices=("none", *DB_BACKENDS),
+        default="none",
+    )
+    parser.add_argument(
+        "--db-config",
+        help="The DB connection config for the postgres backend.",
+        default="db_connections.conf",
+        metavar="",
+    )
+    parser.add_argument(
+        "--schemapath",
+        help="The path to the .yaml file containing the validation schema.",
+        default="yaml_schema.yaml",
+        metavar="",
+    )
+    parser.add_argument(
+        "--validator",
+        help="The validation engine to time.",
+        choices=VALIDATOR_ENGINES,
+        default="fast",
+    )
+    parser.add_argument(
+        "--repeat",
+        help="Run each phase this many times and report the fastest.",
+        type=int,
+        default=3,
+        metavar="",
+    )
+    parser.add_argument(
+        "--seed", help="The seed for the synthetic listings.", type=int, default=0
+    )
+    parser.add_argument(
+        "-o", "--output", help="Write the JSON report to this file.", metavar=""
+    )
+    options = parser.parse_args(args)
+
+    # The DB phases log every statement at INFO, which would drown the timings.
+    logging.basicConfig(encoding="utf-8", level=logging.WARNING)
+
+    if options.backend == "postgres" and os.getenv("PROD_DB") == "true":
+        logging.critical(
+            "Refusing to benchmark the production database, unset PROD_DB to "
+            "use a local PostgreSQL."
+        )
+        sys.exit(1)
+
+    report = run_benchmarks(options)
+    if options.output:
+        with open(options.output, "w", encoding="utf-8") as report_file:
+            json.dump(report, report_file, indent=2)
+            report_file.write("\n")
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,331 @@
+"""Planning listing changes into a changeset file and applying it.
+
+plan computes what applying a batch of listings would change without touching
+the DB, and writes it as a changeset for apply or as a psql script. apply
+executes a changeset in one transaction, refusing it if the DB drifted since
+it was planned.
+"""
+import hashlib
+import json
+import logging
+import sys
+from declarative_config.reconcile import (
+    ARCH_TABLE,
+    decode_override,
+    encode_override,
+    expand_package_listings,
+    listing_fingerprint,
+    product_key,
+    reconcile_overrides,
+)
+from declarative_config.db import (
+    add_overrides,
+    add_overrides_statement,
+    add_tree_product_mappings,
+    add_tree_product_mappings_statement,
+    connect,
+    delete_overrides,
+    delete_overrides_statement,
+    get_products_state,
+    lock_product,
+    log_commit_mode,
+    log_nothing_committed,
+    product_lock_key,
+    resolve_product_id,
+    resolve_product_statement,
+    store_listing_fingerprint,
+    store_listing_fingerprint_statement,
+    transaction,
+    tree_ids_for_given_arches,
+)
+from declarative_config.listings import (
+    YamlBadFormat,
+    find_listing_files,
+    load_listing,
+    load_validator,
+    validate_listing,
+)
+
+
+class ChangesetDrift(Exception):
+    """Called when the DB no longer matches the state a changeset was planned
+    against."""
+
+
+# The version of the changeset file format written by plan_listings().
+CHANGESET_FORMAT = 1
+
+
+def product_state_digest(state):
+    """Summarizes what the DB holds for a product, as returned by
+    get_products_state(), so apply can tell whether it changed since plan."""
+    if state is None:
+        return "absent"
+    canonical = json.dumps(
+        [sorted(map(decode_override, state["overrides"])), sorted(state["tree_ids"])],
+        separators=(",", ":"),
+    )
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def plan_product(key, desired, fingerprint, state):
+    """Computes the changeset records for one product: a product record holding
+    the state it was planned against, followed by its override and
+    tree_product_map changes. Returns an empty list if the product is already
+    up to date."""
+    current = state["overrides"] if state else set()
+    changes = reconcile_overrides(desired, current)
+    tree_ids = {
+        tree_ids_for_given_arches.get(ARCH_TABLE[override[2]]) for override in desired
+    }
+    tree_ids -= state["tree_ids"] if state else set()
+    if (
+        state is not None
+        and not changes.to_insert
+        and not changes.to_delete
+        and not tree_ids
+        and state["fingerprint"] == fingerprint
+    ):
+        return []
+
+    records = [
+        {
+            "op": "product",
+            "product": list(key),
+            "id": state["id"] if state else None,
+            "state": product_state_digest(state),
+            "fingerprint": fingerprint,
+        }
+    ]
+    records.extend(
+        {"op": "insert_override", "product": list(key), "override": list(override)}
+        for override in sorted(map(decode_override, changes.to_insert))
+    )
+    records.extend(
+        {"op": "delete_override", "product": list(key), "override": list(override)}
+        for override in sorted(map(decode_override, changes.to_delete))
+    )
+    records.extend(
+        {"op": "insert_tree_product_map", "product": list(key), "tree_id": tree_id}
+        for tree_id in sorted(tree_ids)
+    )
+    return records
+
+
+def plan_listings(options):
+    """Validates the given listings, fetches the DB state of all of their
+    products in bulk, and writes the changes needed to apply them to a
+    changeset file, one JSON record per line. Nothing is modified in the DB.
+    """
+    filepaths = find_listing_files(options.filepath)
+
+    try:
+        yaml_validator = load_validator(options.schemapath, options.validator)
+        listings = {}
+        for filepath in filepaths:
+            yaml_data = load_listing(filepath)
+            validate_listing(yaml_data, yaml_validator)
+            product = [
+                yaml_data.get("product_name"),
+                yaml_data.get("version"),
+                yaml_data.get("variant"),
+                yaml_data.get("allow_source_only"),
+            ]
+            key = product_key(product)
+            if key in listings:
+                raise ValueError(
+                    "{0} and {1} are listings for the same product.".format(
+                        listings[key][0], filepath
+                    )
+                )
+            desired = expand_package_listings(yaml_data.get("packages", {}))
+            listings[key] = (filepath, desired, listing_fingerprint(product, desired))
+
+        logging.debug("Connecting to the database")
+        my_db = connect()
+        try:
+            states = get_products_state(listings, False, my_db, False)
+        finally:
+            my_db.close()
+
+        records = []
+        for key in sorted(listings):
+            _filepath, desired, fingerprint = listings[key]
+            records.extend(plan_product(key, desired, fingerprint, states.get(key)))
+
+        with open(options.output, "w", encoding="utf-8") as changeset_file:
+            if getattr(options, "format", "changeset") == "sql":
+                write_changeset_sql(changeset_file, filepaths, records)
+            else:
+                header = {
+                    "op": "header",
+                    "format": CHANGESET_FORMAT,
+                    "listings": filepaths,
+                }
+                changeset_file.write(json.dumps(header) + "\n")
+                for record in records:
+                    changeset_file.write(json.dumps(record) + "\n")
+
+    except YamlBadFormat as _e:
+        logging.critical("The yaml data failed validation against the schema.")
+        logging.critical("No changeset was written.")
+        logging.debug(_e.errors)
+        sys.exit(1)
+    except Exception as _e:
+        logging.exception(_e)
+        sys.exit(1)
+
+    products = [record for record in records if record["op"] == "product"]
+    logging.info(
+        "Wrote {0} changes for {1} of {2} products to {3}.".format(
+            len(records) - len(products),
+            len(products),
+            len(listings),
+            options.output,
+        )
+    )
+
+
+def write_changeset_sql(script_file, filepaths, records):
+    """Writes changeset records as a script for psql -f. The whole script runs
+    in one transaction and stops at the first error, with one set-based
+    statement per kind of change and product, one VALUES row per line.
+
+    Each product id is resolved by the script itself into the product_id psql
+    variable, as new products only get theirs when the script runs. Unlike
+    apply, the script does not check whether the DB drifted since the plan.
+    """
+    script_file.write("-- Generated by declarative_config plan from:\n")
+    for filepath in filepaths:
+        script_file.write("--   {0}\n".format(filepath))
+    script_file.write("\\set ON_ERROR_STOP on\n\nBEGIN;\n")
+
+    # Records come grouped by product, each group led by its product record.
+    groups = []
+    for record in records:
+        if record["op"] == "product":
+            groups.append((record, {"insert_override": [], "delete_override": []}))
+        elif record["op"] == "insert_tree_product_map":
+            groups[-1][1].setdefault("tree_ids", []).append(record["tree_id"])
+        else:
+            groups[-1][1][record["op"]].append(encode_override(*record["override"]))
+
+    prod_id = ":product_id"
+    for record, changes in groups:
+        product = record["product"]
+        script_file.write(
+            "\n-- Product {0}, version {1}, variant {2}, "
+            "allow_source_only {3}\n".format(*product)
+        )
+        script_file.write(
+            "SELECT pg_advisory_xact_lock({0});\n".format(product_lock_key(product))
+        )
+        script_file.write(resolve_product_statement(product) + " \\gset product_\n")
+        statements = [
+            add_overrides_statement(changes["insert_override"], prod_id),
+            delete_overrides_statement(changes["delete_override"], prod_id),
+            add_tree_product_mappings_statement(changes.get("tree_ids", []), prod_id),
+            store_listing_fingerprint_statement(prod_id, record["fingerprint"]),
+        ]
+        for statement in statements:
+            if statement is not None:
+                script_file.write(statement + ";\n")
+
+    script_file.write("\nCOMMIT;\n")
+
+
+def load_changeset(filepath):
+    """Reads a changeset file written by plan_listings(). Returns a dictionary
+    from product key to its product record, with the override and
+    tree_product_map records of the product gathered under "changes"."""
+    products = {}
+    with open(filepath, encoding="utf-8") as changeset_file:
+        header = json.loads(changeset_file.readline() or "{}")
+        if header.get("op") != "header" or header.get("format") != CHANGESET_FORMAT:
+            raise ValueError("{0} is not a changeset file.".format(filepath))
+        for line in changeset_file:
+            record = json.loads(line)
+            key = product_key(record["product"])
+            if record["op"] == "product":
+                products[key] = dict(record, changes=[])
+            else:
+                products[key]["changes"].append(record)
+    return products
+
+
+def apply_changeset(options):
+    """Executes a changeset file written by plan_listings() in a single
+    transaction. Every product in it is locked and its DB state compared with
+    the state it was planned against first, and the whole changeset is refused
+    if any of them drifted."""
+    log_commit_mode(options.commit)
+
+    try:
+        products = load_changeset(options.changeset)
+        logging.debug("Connecting to the database")
+        my_db = connect()
+        try:
+            with transaction(options.commit, my_db, options.print_changes_only):
+                for key in sorted(products):
+                    lock_product(key, options.commit, my_db, options.print_changes_only)
+
+                states = get_products_state(
+                    products, options.commit, my_db, options.print_changes_only
+                )
+                drifted = [
+                    key
+                    for key in sorted(products)
+                    if product_state_digest(states.get(key)) != products[key]["state"]
+                ]
+                if drifted:
+                    raise ChangesetDrift(
+                        "The DB changed since the changeset was planned for "
+                        + ", ".join("/".join(map(str, key[:3])) for key in drifted)
+                    )
+
+                for key in sorted(products):
+                    apply_planned_product(
+                        key, products[key], states.get(key), options, my_db
+                    )
+        finally:
+            my_db.close()
+    except ChangesetDrift as _e:
+        logging.critical(
+            "{0}. Nothing was applied, plan the listings again.".format(_e)
+        )
+        sys.exit(1)
+    except Exception as _e:
+        logging.exception(_e)
+        sys.exit(1)
+
+    logging.info("Applied changes for {0} products.".format(len(products)))
+    log_nothing_committed(options.commit)
+
+
+def apply_planned_product(key, planned, state, options, my_db):
+    """Executes the changeset records of one product, with one statement
+    per kind of change."""
+    commit, print_changes_only = options.commit, options.print_changes_only
+    if state is None:
+        prod_id = resolve_product_id(list(key), commit, my_db, print_changes_only)
+    else:
+        prod_id = state["id"]
+
+    changes = {"insert_override": [], "delete_override": []}
+    tree_ids = []
+    for record in planned["changes"]:
+        if record["op"] == "insert_tree_product_map":
+            tree_ids.append(record["tree_id"])
+        else:
+            changes[record["op"]].append(encode_override(*record["override"]))
+
+    add_overrides(
+        changes["insert_override"], prod_id, commit, my_db, print_changes_only
+    )
+    delete_overrides(
+        changes["delete_override"], prod_id, commit, my_db, print_changes_only
+    )
+    add_tree_product_mappings(tree_ids, prod_id, commit, my_db, print_changes_only)
+    store_listing_fingerprint(
+        prod_id, planned["fingerprint"], commit, my_db, print_changes_only
+    )
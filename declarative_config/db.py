@@ -0,0 +1,601 @@
+"""The DB interfacing functions of declarative config.
+
+Every statement goes through exec_query(), which only executes writes when
+committing and records each statement in query_stats. Statements that apply
+many overrides at once are built by the *_statement() functions, so they can
+also be written to a psql script.
+"""
+from contextlib import contextmanager
+import hashlib
+import importlib
+import logging
+import os
+import time
+import configparser
+import pg
+from declarative_config.profiling import phase_timer, query_stats, statement_kind
+from declarative_config.reconcile import (
+    ARCH_TABLE,
+    decode_override,
+    normalize_overrides,
+    product_key,
+)
+
+# contains the tree id that maps to a given architecture.
+# Used only in the tree_prod_map table.
+tree_ids_for_given_arches = {
+    "i386": 5559,
+    "ia64": 5899,
+    "aarch64": 51630,
+    "ppc": 5901,
+    "ppc64": 17097,
+    "ppc64le": 46533,
+    "s390": 9867,
+    "s390x": 5900,
+    "x86_64": 5558,
+}
+
+
+def connect_postgres(db_settings):
+    """Open a connection to PostgreSQL with the settings of a
+    db_connections.conf profile."""
+    return pg.DB(
+        db_settings["DB_NAME"],
+        host=db_settings["DB_HOST"],
+        user=db_settings["DB_USER"],
+        passwd=db_settings["DB_PASSWD"],
+    )
+
+
+def connect_memory(db_settings):
+    """Open a connection to the in-memory database of this process. Its module
+    is only imported when this backend is used."""
+    memory_db = importlib.import_module("declarative_config.memory_db")
+    return memory_db.connect(db_settings)
+
+
+# The DB backends connect() can open, by name. Each takes the settings of the
+# selected db_connections.conf profile and returns an object with the subset
+# of pg.DB used here: query(), which returns rows with dictresult() and
+# getresult() or the number of rows changed, and close().
+DB_BACKENDS = {"postgres": connect_postgres, "memory": connect_memory}
+
+
+# Copied from prod_listings.py
+def selected_backend(path="db_connections.conf"):
+    """Returns the name of the backend connect() opens, named by the DB_BACKEND
+    environment variable or the BACKEND setting of the profile, PostgreSQL by
+    default, along with the settings of the profile."""
+    db_config = configparser.ConfigParser()
+    profile = ""
+
+    if os.getenv("PROD_DB") == "true":
+        profile = "production"
+    elif "CI" in os.environ:
+        profile = "ci_test"
+    else:
+        profile = "local_test"
+
+    db_config.read(path)
+    db_settings = db_config[profile] if db_config.has_section(profile) else {}
+
+    backend = os.getenv("DB_BACKEND") or db_settings.get("BACKEND", "postgres")
+    if backend not in DB_BACKENDS:
+        raise ValueError(
+            "Unknown DB backend {0}, expected one of {1}.".format(
+                backend, ", ".join(DB_BACKENDS)
+            )
+        )
+    return backend, db_settings
+
+
+def connect(path="db_connections.conf"):
+    """Connect to the database, with the backend chosen by selected_backend()."""
+    backend, db_settings = selected_backend(path)
+    with phase_timer.phase("connect"):
+        my_db = DB_BACKENDS[backend](db_settings)
+    return my_db
+
+
+def _rows_affected(result):
+    """The number of rows a statement returned or changed, from what
+    my_db.query() returned for it."""
+    if isinstance(result, str):
+        return int(result) if result.isdigit() else 0
+    # A pg.Query holding rows returned by the statement, or None.
+    return len(result) if hasattr(result, "__len__") else 0
+
+
+def exec_query(query, commit, my_db, print_changes_only, tuples=False):
+    """Execute a query, recording it in query_stats. The rows of a SELECT come
+    back as dicts, or as tuples with tuples set, which skips building a dict
+    per row."""
+    if query.startswith("SELECT"):
+        if not print_changes_only:
+            logging.info("Executing: " + query)
+        started = time.perf_counter()
+        with phase_timer.phase("read"):
+            result = my_db.query(query)
+            result = result.getresult() if tuples else result.dictresult()
+        query_stats.record(
+            statement_kind(query), time.perf_counter() - started, len(result)
+        )
+        logging.debug("Query returned: " + str(result))
+        return result
+
+    if commit:
+        logging.info("Executing:" + query)
+        started = time.perf_counter()
+        with phase_timer.phase("write"):
+            result = my_db.query(query)
+        query_stats.record(
+            statement_kind(query),
+            time.perf_counter() - started,
+            _rows_affected(result),
+        )
+        logging.debug("Query returned: " + str(result))
+        return result
+
+    logging.info("Would have executed: " + query)
+
+
+def read_query(query, my_db, kind):
+    """Execute a statement generate reads the DB with, recording it in
+    query_stats as kind. Unlike exec_query(), it runs without --commit and
+    returns what my_db.query() returned, for getresult()."""
+    logging.debug("Executing: " + query)
+    started = time.perf_counter()
+    with phase_timer.phase("read"):
+        result = my_db.query(query)
+    query_stats.record(kind, time.perf_counter() - started, _rows_affected(result))
+    return result
+
+
+def log_commit_mode(commit):
+    """Tells up front that a run will not modify the database."""
+    if not commit:
+        logging.info(
+            "The --commit option was not specified, "
+            + "so the database will not be modified."
+        )
+
+
+def log_nothing_committed(commit):
+    """Reminds at the end of a run that nothing was changed."""
+    if not commit:
+        logging.info(
+            "Did not run any INSERT or DELETE database queries. Nothing "
+            + "was changed. Rerun with --commit to apply the above changes."
+        )
+
+
+@contextmanager
+def transaction(commit, my_db, print_changes_only):
+    """Run the enclosed queries in a single transaction, which is committed when
+    the block completes and rolled back if it raises."""
+    exec_query("BEGIN", commit, my_db, print_changes_only)
+    try:
+        yield
+    except BaseException:
+        if commit:
+            logging.info("Rolling back the transaction.")
+            my_db.query("ROLLBACK")
+        raise
+    exec_query("COMMIT", commit, my_db, print_changes_only)
+
+
+def product_lock_key(product):
+    """Derives the advisory lock key for a product from its label, version and
+    variant. The key has to be the same in every process, so it is taken from
+    a digest rather than Python's per-process salted hash().
+
+    product should come in as a list whose first item is the label,
+    second is version, and third is variant."""
+    name = "{0}/{1}/{2}".format(product[0], product[1], product[2])
+    digest = hashlib.blake2b(name.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big", signed=True)
+
+
+def lock_product(product, commit, my_db, print_changes_only):
+    """Take the transaction-level advisory lock for a product, so concurrent
+    runs applying the same product are serialized while unrelated products
+    proceed in parallel. The lock is released when the transaction ends.
+
+    product should come in as a list whose first item is the label,
+    second is version, and third is variant."""
+    if not commit:
+        # Nothing is written, and there is no transaction to hold the lock.
+        return
+
+    key = product_lock_key(product)
+    query = "SELECT pg_try_advisory_xact_lock({0}) AS locked".format(key)
+    if exec_query(query, commit, my_db, print_changes_only)[0]["locked"]:
+        return
+
+    logging.warning(
+        "Product {0}, version {1}, variant {2} is locked by another run, "
+        "waiting for it to finish.".format(product[0], product[1], product[2])
+    )
+    started = time.monotonic()
+    query = "SELECT pg_advisory_xact_lock({0})".format(key)
+    exec_query(query, commit, my_db, print_changes_only)
+    logging.warning(
+        "Waited {0:.2f}s for the lock on product {1}, version {2}, "
+        "variant {3}.".format(
+            time.monotonic() - started, product[0], product[1], product[2]
+        )
+    )
+
+
+def delete_overrides_statement(overrides, prod_id):
+    """Build the DELETE removing the given overrides of a product, or return
+    None if there are none. Only rows with include set are ever removed:
+    exclusion overrides among the given keys are skipped, and exclusion rows
+    in the table are never matched."""
+    values = [
+        "('{0}', '{1}', '{2}')".format(pkg_name, pkg_arch, prod_arch)
+        for pkg_name, pkg_arch, prod_arch, include in sorted(
+            map(decode_override, overrides)
+        )
+        if include
+    ]
+    if not values:
+        return None
+
+    return """DELETE from overrides
+    USING (VALUES
+    {0}
+    ) AS stale (name, pkg_arch, product_arch)
+    where overrides.product = {1} and
+    overrides.name = stale.name and
+    overrides.pkg_arch = stale.pkg_arch and
+    overrides.product_arch = stale.product_arch and
+    overrides.include = true""".format(
+        ",\n    ".join(values), prod_id
+    )
+
+
+def delete_overrides(overrides, prod_id, commit, my_db, print_changes_only):
+    """Delete the override packages that weren't in the yaml file with a single
+    DELETE joined against a VALUES list.
+
+    overrides should come in as an iterable of compact override keys, as
+    computed by reconcile_overrides(). Returns the number of rows deleted, or
+    the number that would have been deleted when not committing."""
+    query = delete_overrides_statement(overrides, prod_id)
+    if query is None:
+        return 0
+
+    result = exec_query(query, commit, my_db, print_changes_only)
+    deleted = int(result) if commit else sum(1 for key in overrides if key[3])
+    logging.info(
+        "{0} {1} stale overrides for product ID {2}.".format(
+            "Deleted" if commit else "Would have deleted", deleted, prod_id
+        )
+    )
+    return deleted
+
+
+def get_product_overrides(prod_id, commit, my_db, print_changes_only):
+    """Get the overrides entries for a given product, as the set of override
+    keys made by normalize_overrides()."""
+    query = """SELECT name, pkg_arch, product_arch, include FROM overrides
+    WHERE product = '{0}'""".format(
+        prod_id
+    )
+    rows = exec_query(query, commit, my_db, print_changes_only, tuples=True)
+    return normalize_overrides(rows)
+
+
+# Copied from prod_listings.py
+def get_product_id(product, commit, my_db, print_changes_only):
+    """Get the id for a given product table entry.
+
+    product should come in as a list whose first item is the label,
+    second is version, third is variant, and fourth is allow_source_only."""
+    label, version, variant, allow_source_only = (
+        product[0],
+        product[1],
+        product[2],
+        product[3],
+    )
+    query = """SELECT id FROM products
+    WHERE label = '{0}'and
+    version = '{1}' and
+    variant = '{2}' and
+    allow_source_only = '{3}'
+    order by id""".format(
+        label, version, variant, allow_source_only
+    )
+    products = exec_query(query, commit, my_db, print_changes_only)
+    if products:
+        return products[0]["id"]
+    # The following can only be executed in no-commit mode
+    # Where the product listing hasn't previously been inserted.
+    logging.info(
+        "No entry exists yet, substituting a fake ID of 0. In commit "
+        + "mode all occurrences of product ID would use the real ID."
+    )
+    return 0
+
+
+def resolve_product_statement(product):
+    """Build the statement inserting into products if the entry is not already
+    there and selecting its id.
+
+    There is no unique constraint on the products columns to use
+    INSERT ... ON CONFLICT with, so the existing row is looked up and the
+    insert is guarded by it inside the same statement.
+
+    product should come in as a list whose first item is the label,
+    second is version, third is variant, and fourth is allow_source_only."""
+    label, version, variant, allow_source_only = (
+        product[0],
+        product[1],
+        product[2],
+        product[3],
+    )
+    return """WITH existing AS (
+    SELECT id FROM products
+    where label = '{0}' and
+    version = '{1}' and
+    variant = '{2}' and
+    allow_source_only = '{3}'
+    order by id limit 1
+    ), inserted AS (
+    INSERT into products (id, label, version, variant, allow_source_only)
+    SELECT nextval('products_id_seq'), '{0}', '{1}', '{2}', '{3}'
+    where not exists (SELECT from existing)
+    RETURNING id
+    )
+    SELECT id FROM existing UNION ALL SELECT id FROM inserted""".format(
+        label, version, variant, allow_source_only
+    )
+
+
+def resolve_product_id(product, commit, my_db, print_changes_only):
+    """Insert into products if the entry is not already there and return its id,
+    in a single round trip.
+
+    product should come in as a list whose first item is the label,
+    second is version, third is variant, and fourth is allow_source_only."""
+    query = resolve_product_statement(product)
+    result = exec_query(query, commit, my_db, print_changes_only)
+
+    if not commit:
+        # Nothing was inserted, so fall back to looking up an existing entry.
+        return get_product_id(product, commit, my_db, print_changes_only)
+
+    return result.dictresult()[0]["id"]
+
+
+def add_overrides_statement(overrides, prod_id):
+    """Build the multi-row INSERT adding the given overrides to a product, or
+    return None if there are none."""
+    values = [
+        "('{0}', '{1}', '{2}', {3}, '{4}')".format(
+            pkg_name, pkg_arch, prod_arch, prod_id, include
+        )
+        for pkg_name, pkg_arch, prod_arch, include in sorted(
+            map(decode_override, overrides)
+        )
+    ]
+    if not values:
+        return None
+
+    return """INSERT into overrides
+    (name, pkg_arch, product_arch, product, include)
+    VALUES
+    {0}""".format(
+        ",\n    ".join(values)
+    )
+
+
+def add_overrides(overrides, prod_id, commit, my_db, print_changes_only):
+    """Insert new overrides for a product with a single multi-row INSERT.
+
+    overrides should come in as an iterable of compact override keys that are
+    known not to be in the overrides table yet, as computed by
+    reconcile_overrides(). Returns the number of rows sent."""
+    query = add_overrides_statement(overrides, prod_id)
+    if query is None:
+        return 0
+
+    exec_query(query, commit, my_db, print_changes_only)
+    return len(overrides)
+
+
+def get_product_tree_ids(prod_id, commit, my_db, print_changes_only):
+    """Get the ids of the trees a product is mapped to, as a set."""
+    query = """SELECT tree_id, product_id FROM tree_product_map
+    WHERE product_id = '{0}'""".format(
+        prod_id
+    )
+    rows = exec_query(query, commit, my_db, print_changes_only, tuples=True)
+    return {row[0] for row in rows}
+
+
+def add_tree_product_mappings_statement(tree_ids, prod_id):
+    """Build the INSERT mapping the given trees to a product, or return None if
+    there are none."""
+    values = ["({0}, {1})".format(tree_id, prod_id) for tree_id in sorted(tree_ids)]
+    if not values:
+        return None
+
+    return """INSERT into tree_product_map (tree_id, product_id)
+    VALUES
+    {0}""".format(
+        ",\n    ".join(values)
+    )
+
+
+def add_tree_product_mappings(tree_ids, prod_id, commit, my_db, print_changes_only):
+    """Insert tree_product_map entries for a product with a single statement.
+
+    tree_ids should come in as an iterable of tree ids that are known not to be
+    mapped to the product yet. Returns the number of rows sent."""
+    query = add_tree_product_mappings_statement(tree_ids, prod_id)
+    if query is None:
+        return 0
+
+    exec_query(query, commit, my_db, print_changes_only)
+    return len(tree_ids)
+
+
+def get_products_state(products, commit, my_db, print_changes_only):
+    """Get the id, stored listing fingerprint, overrides and tree ids of many
+    products at once, with one query per table.
+
+    products should come in as an iterable of product keys, as returned by
+    product_key(). Returns a dictionary from product key to a dictionary with
+    "id", "fingerprint", "overrides" (a set of override keys) and "tree_ids"
+    (a set). Products that are not in the DB are left out."""
+    keys = sorted(set(products))
+    if not keys:
+        return {}
+
+    query = """SELECT products.id, label, version, variant, allow_source_only,
+    listing_fingerprints.fingerprint
+    FROM products LEFT JOIN listing_fingerprints
+    ON listing_fingerprints.product_id = products.id
+    WHERE (label, version, variant, allow_source_only) IN (VALUES
+    {0}
+    )
+    order by products.id""".format(
+        ",\n    ".join("('{0}', '{1}', '{2}', {3})".format(*key) for key in keys)
+    )
+    states = {}
+    for row in exec_query(query, commit, my_db, print_changes_only):
+        key = product_key(
+            [row["label"], row["version"], row["variant"], row["allow_source_only"]]
+        )
+        # Like get_product_id(), the lowest id wins if there are duplicates.
+        if key not in states:
+            states[key] = {
+                "id": row["id"],
+                "fingerprint": row["fingerprint"],
+                "overrides": set(),
+                "tree_ids": set(),
+            }
+    if not states:
+        return states
+
+    by_id = {state["id"]: state for state in states.values()}
+    prod_ids = ", ".join(str(prod_id) for prod_id in sorted(by_id))
+
+    query = """SELECT name, pkg_arch, product_arch, include, product FROM overrides
+    WHERE product IN ({0})""".format(
+        prod_ids
+    )
+    rows_by_id = {}
+    for row in exec_query(query, commit, my_db, print_changes_only, tuples=True):
+        rows_by_id.setdefault(row[4], []).append(row)
+    for prod_id, rows in rows_by_id.items():
+        by_id[prod_id]["overrides"] = normalize_overrides(rows)
+
+    query = """SELECT tree_id, product_id FROM tree_product_map
+    WHERE product_id IN ({0})""".format(
+        prod_ids
+    )
+    for row in exec_query(query, commit, my_db, print_changes_only):
+        by_id[row["product_id"]]["tree_ids"].add(row["tree_id"])
+
+    return states
+
+
+def get_listing_fingerprint(product, commit, my_db, print_changes_only):
+    """Look up a product and the fingerprint of the listing last applied to it,
+    in a single query. Returns (None, None) if there is no such product and
+    (prod_id, None) if no fingerprint was stored for it.
+
+    product should come in as a list whose first item is the label,
+    second is version, third is variant, and fourth is allow_source_only."""
+    label, version, variant, allow_source_only = (
+        product[0],
+        product[1],
+        product[2],
+        product[3],
+    )
+    query = """SELECT products.id, listing_fingerprints.fingerprint
+    FROM products LEFT JOIN listing_fingerprints
+    ON listing_fingerprints.product_id = products.id
+    WHERE label = '{0}' and
+    version = '{1}' and
+    variant = '{2}' and
+    allow_source_only = '{3}'
+    order by products.id limit 1""".format(
+        label, version, variant, allow_source_only
+    )
+    result = exec_query(query, commit, my_db, print_changes_only)
+    if not result:
+        return None, None
+    return result[0]["id"], result[0]["fingerprint"]
+
+
+def store_listing_fingerprint_statement(prod_id, fingerprint):
+    """Build the upsert recording the listing fingerprint of a product."""
+    return """INSERT into listing_fingerprints (product_id, fingerprint)
+    VALUES ({0}, '{1}')
+    ON CONFLICT (product_id) DO UPDATE SET fingerprint = EXCLUDED.fingerprint""".format(
+        prod_id, fingerprint
+    )
+
+
+def store_listing_fingerprint(prod_id, fingerprint, commit, my_db, print_changes_only):
+    """Record the fingerprint of the listing just applied to a product."""
+    query = store_listing_fingerprint_statement(prod_id, fingerprint)
+    exec_query(query, commit, my_db, print_changes_only)
+
+
+def get_last_synced_commit(source, commit, my_db, print_changes_only):
+    """Get the git commit the listings in a directory were last synced from,
+    or None if they were never synced.
+
+    source is the directory's path relative to the top of its git checkout."""
+    query = """SELECT last_commit FROM listing_sync_state
+    WHERE source = '{0}'""".format(
+        source
+    )
+    result = exec_query(query, commit, my_db, print_changes_only)
+    if not result:
+        return None
+    return result[0]["last_commit"]
+
+
+def store_last_synced_commit(source, git_commit, commit, my_db, print_changes_only):
+    """Record the git commit the listings in a directory were just synced from.
+
+    source is the directory's path relative to the top of its git checkout."""
+    query = """INSERT into listing_sync_state (source, last_commit)
+    VALUES ('{0}', '{1}')
+    ON CONFLICT (source) DO UPDATE SET last_commit = EXCLUDED.last_commit""".format(
+        source, git_commit
+    )
+    exec_query(query, commit, my_db, print_changes_only)
+
+
+def apply_override_changes(changes, prod_id, commit, my_db, print_changes_only):
+    """Executes the queries needed to bring the DB in line with the reconciled
+    changes for a product: inserts new overrides, deletes stale ones and makes
+    sure every product arch in the listing has a tree_product_map entry.
+    """
+    logging.info(
+        "Overrides for product ID {0}: {1} to insert, {2} to delete, "
+        "{3} unchanged.".format(
+            prod_id,
+            len(changes.to_insert),
+            len(changes.to_delete),
+            len(changes.unchanged),
+        )
+    )
+
+    add_overrides(changes.to_insert, prod_id, commit, my_db, print_changes_only)
+
+    delete_overrides(changes.to_delete, prod_id, commit, my_db, print_changes_only)
+
+    tree_ids = {
+        tree_ids_for_given_arches.get(ARCH_TABLE[key[2]])
+        for key in changes.to_insert | changes.unchanged
+    }
+    tree_ids -= get_product_tree_ids(prod_id, commit, my_db, print_changes_only)
+    add_tree_product_mappings(tree_ids, prod_id, commit, my_db, print_changes_only)
@@ -0,0 +1,390 @@
+"""Writing product listings from the DB to yaml files.
+
+A single listing is streamed from a server-side cursor to its file, and
+generate --all mirrors every listing in the DB into a directory, only
+rewriting the listings whose rows changed since the previous export.
+"""
+import hashlib
+import itertools
+import json
+import logging
+import sys
+import os
+import re
+import textwrap
+import yaml
+from declarative_config.profiling import phase_timer
+from declarative_config.reconcile import ARCH_TABLE, NOARCH, SRC, compact_rows
+from declarative_config.db import connect, read_query
+
+# Use the libyaml-backed safe dumper when PyYAML was built with it, it is
+# several times faster than the pure Python one and writes the same listings.
+try:
+    from yaml import CSafeDumper as YamlDumper
+except ImportError:
+    from yaml import SafeDumper as YamlDumper
+
+
+class NoListingsFound(Exception):
+    """Called when the given input matches no entry in the DB."""
+
+
+def listing_header(product):
+    """Builds the yaml data of a product listing, without its packages, from
+    its products row."""
+    # The products row carries the product version and variant, which match
+    # the requested identifiers too, so there are many ways to reference them.
+    return {
+        "product_name": product[1],
+        "version": float(product[2]),
+        "variant": product[3],
+        "allow_source_only": product[4],
+    }
+
+
+def add_package_offering(offerings, pkg_arch, prod_arch):
+    """Adds one override row of a package to its yaml offerings, given the
+    ARCH_TABLE codes of its arches."""
+    if pkg_arch == prod_arch:
+        offerings.setdefault("arch", []).append(ARCH_TABLE[pkg_arch])
+    elif pkg_arch == SRC:
+        offerings.setdefault("src", []).append(ARCH_TABLE[prod_arch])
+    elif pkg_arch == NOARCH:
+        offerings.setdefault("noarch", []).append(ARCH_TABLE[prod_arch])
+    else:
+        offerings.setdefault("multilib", []).append(
+            {ARCH_TABLE[pkg_arch]: ARCH_TABLE[prod_arch]}
+        )
+
+
+def listing_from_rows(product, overrides):
+    """Builds the yaml data of a product listing from its products row and the
+    compact (name, pkg_arch, product_arch, ...) rows of its overrides, as made
+    by compact_rows() or encode_override()."""
+    yaml_data = listing_header(product)
+    yaml_package_listings = {}
+    for package in overrides:
+        add_package_offering(
+            yaml_package_listings.setdefault(package[0], {}), package[1], package[2]
+        )
+
+    # Leave the packages category out altogether if there are zero packages listed
+    if yaml_package_listings:
+        yaml_data["packages"] = yaml_package_listings
+
+    return yaml_data
+
+
+# The order package offerings are listed in, as in the schema.
+OFFERING_KINDS = ("arch", "src", "noarch", "multilib")
+
+
+def canonical_offerings(offerings):
+    """Puts the offerings of a package in canonical order: the kinds in schema
+    order, each with its arches sorted and deduplicated, and multilib entries
+    sorted by package arch and then product arch."""
+    canonical = {}
+    for kind in OFFERING_KINDS:
+        if kind not in offerings:
+            continue
+        if kind == "multilib":
+            pairs = {pair for entry in offerings[kind] for pair in entry.items()}
+            canonical[kind] = [{pkg: prod} for pkg, prod in sorted(pairs)]
+        else:
+            canonical[kind] = sorted(set(offerings[kind]))
+    return canonical
+
+
+def canonical_listing(yaml_data):
+    """Puts the yaml data of a product listing in canonical order, with its
+    packages sorted by name, so that the same rows always dump to the same
+    bytes whatever order the DB returned them in."""
+    if "packages" in yaml_data:
+        yaml_data["packages"] = {
+            pkg_name: canonical_offerings(yaml_data["packages"][pkg_name])
+            for pkg_name in sorted(yaml_data["packages"])
+        }
+    return yaml_data
+
+
+def package_blocks(overrides):
+    """Groups compact (name, pkg_arch, product_arch, ...) rows ordered by package
+    name into (name, offerings) pairs, yielding each package as soon as its last
+    row has been read."""
+    for pkg_name, rows in itertools.groupby(overrides, key=lambda row: row[0]):
+        offerings = {}
+        for package in rows:
+            add_package_offering(offerings, package[1], package[2])
+        yield pkg_name, offerings
+
+
+def write_listing(yaml_data, filepath):
+    """Dumps the yaml data of a product listing to a file."""
+    with phase_timer.phase("write"), open(filepath, "w", encoding="ascii") as yaml_file:
+        yaml_file.write("---\n")
+        yaml.dump(yaml_data, yaml_file, Dumper=YamlDumper, sort_keys=False)
+
+
+def write_listing_blocks(header, blocks, yaml_file):
+    """Writes a product listing to an open file one package block at a time,
+    in the same layout as write_listing(). Returns the number of packages."""
+    yaml_file.write("---\n")
+    yaml.dump(header, yaml_file, Dumper=YamlDumper, sort_keys=False)
+    written = 0
+    for pkg_name, offerings in blocks:
+        if not written:
+            yaml_file.write("packages:\n")
+        block = yaml.dump({pkg_name: offerings}, Dumper=YamlDumper, sort_keys=False)
+        yaml_file.write(textwrap.indent(block, "  "))
+        written += 1
+    return written
+
+
+def fetch_in_batches(my_db, query, batch_size, cursor_name="generate_overrides"):
+    """Streams the rows of a query through a named server-side cursor, fetching
+    batch_size rows per round trip, so only one batch is held in memory. Its
+    statements are recorded in query_stats as "generate fetch"."""
+    read_query("BEGIN", my_db, "generate fetch")
+    try:
+        read_query(
+            "DECLARE {0} NO SCROLL CURSOR FOR {1}".format(cursor_name, query),
+            my_db,
+            "generate fetch",
+        )
+        fetch = "FETCH FORWARD {0} FROM {1}".format(batch_size, cursor_name)
+        while True:
+            rows = read_query(fetch, my_db, "generate fetch").getresult()
+            if not rows:
+                break
+            yield from rows
+    finally:
+        # Nothing was written, so ending the transaction either way closes the
+        # cursor.
+        read_query("ROLLBACK", my_db, "generate fetch")
+
+
+def listing_filename(label, version, variant):
+    """Names the yaml file of a product listing in an exported directory, as
+    <label>_<version>_<variant>.yaml with anything but letters, digits, dots
+    and dashes replaced by underscores."""
+    name = "{0}_{1}_{2}".format(label, version, variant)
+    return re.sub(r"[^A-Za-z0-9.-]", "_", name) + ".yaml"
+
+
+def generate_yaml(options):
+    """Connects to the database, queries the requested information,
+    stores in a Python dictionary structure and dumps to the specified yaml file.
+    Takes as input the parsed arguments from the commandline.
+    """
+    if getattr(options, "all", False):
+        generate_all_yaml(options)
+        return
+
+    if not os.path.exists(os.path.dirname(options.filepath)):
+        os.mkdir(os.path.dirname(options.filepath))
+
+    logging.info("Connecting to DB and querying products and overrides...")
+    my_db = connect()
+    partial_filepath = options.filepath + ".partial"
+    overrides = None
+
+    try:
+        query = """select * from products
+        where label = '{0}' and version = '{1}' and variant = '{2}'""".format(
+            options.product, options.version, options.variant
+        )
+        products = read_query(query, my_db, "generate lookup").getresult()
+        if not products:
+            raise NoListingsFound
+
+        prod_ids = []
+        for prod in products:
+            prod_ids.append(str(prod[0]))
+        prod_ids = "(" + ", ".join(prod_ids) + ")"
+        logging.debug("Product ID's found: " + prod_ids)
+
+        # Package names are compared bytewise in canonical mode, as Python
+        # sorts them, rather than by the collation of the DB.
+        query = """select name, pkg_arch, product_arch, product from overrides
+        where product in {0}
+        order by name{1}""".format(
+            prod_ids, ' COLLATE "C"' if options.canonical else ""
+        )
+        overrides = fetch_in_batches(my_db, query, options.batch_size)
+        blocks = package_blocks(compact_rows(overrides))
+        if options.canonical:
+            blocks = (
+                (pkg_name, canonical_offerings(offerings))
+                for pkg_name, offerings in blocks
+            )
+
+        # Here I use the 0th result to get product version and variant, but each
+        # result has the same.
+        header = listing_header(products[0])
+
+        # Packages are written out as their rows arrive, into a temporary file
+        # that only replaces the target once the listing is complete.
+        logging.info("Dumping to file...")
+        with phase_timer.phase("write"), open(
+            partial_filepath, "w", encoding="ascii"
+        ) as yaml_file:
+            packages = write_listing_blocks(header, blocks, yaml_file)
+        os.replace(partial_filepath, options.filepath)
+        logging.debug("Wrote {0} packages.".format(packages))
+        logging.info("Success! Yaml data is stored in {0}.".format(options.filepath))
+
+    except NoListingsFound:
+        logging.critical(
+            """The database has no row for {0}, version {1}, and variant {2}.
+            No file was written.""".format(
+                options.product, options.version, options.variant
+            )
+        )
+        sys.exit(1)
+    except Exception as _e:
+        logging.exception(_e)
+        sys.exit(1)
+    finally:
+        # Ends the cursor's transaction if writing stopped half way, before the
+        # connection goes.
+        if overrides is not None:
+            overrides.close()
+        my_db.close()
+        # A listing that failed half way is not left next to the target.
+        if os.path.exists(partial_filepath):
+            os.remove(partial_filepath)
+
+
+# The file in an exported directory recording the rows each listing was
+# written from.
+MIRROR_MANIFEST = ".manifest.json"
+
+
+def listing_rows_fingerprint(product, overrides, canonical=False):
+    """Computes a digest of the products row and override rows a listing is
+    written from, independent of the order the DB returned them in. Listings
+    written in canonical order get a different digest."""
+    digested = json.dumps(
+        [
+            canonical,
+            [str(field) for field in product[1:5]],
+            sorted(
+                [row[0], ARCH_TABLE[row[1]], ARCH_TABLE[row[2]]] for row in overrides
+            ),
+        ],
+        separators=(",", ":"),
+    )
+    return hashlib.sha256(digested.encode("utf-8")).hexdigest()
+
+
+def mirror_listings(listings, directory, full=False, canonical=False):
+    """Brings a directory of exported listings up to date. Only listings whose
+    rows changed since the previous export are rewritten, and listings that no
+    longer exist are removed, as recorded in the MIRROR_MANIFEST file.
+
+    listings should come in as a dictionary from file name to the products row
+    and compact override rows of the listing. If full is set, every listing is
+    rewritten, and if canonical is set, listings are written in canonical
+    order. Returns the number of files written and removed."""
+    os.makedirs(directory, exist_ok=True)
+    manifest_path = os.path.join(directory, MIRROR_MANIFEST)
+    previous = {}
+    if not full and os.path.exists(manifest_path):
+        with open(manifest_path, encoding="utf-8") as manifest_file:
+            previous = json.load(manifest_file)
+
+    manifest = {}
+    written = 0
+    for filename, (header, rows) in sorted(listings.items()):
+        manifest[filename] = listing_rows_fingerprint(header, rows, canonical)
+        filepath = os.path.join(directory, filename)
+        if previous.get(filename) == manifest[filename] and os.path.exists(filepath):
+            continue
+        yaml_data = listing_from_rows(header, rows)
+        if canonical:
+            yaml_data = canonical_listing(yaml_data)
+        write_listing(yaml_data, filepath)
+        logging.debug("Wrote " + filepath)
+        written += 1
+
+    # Only files written by a previous export are removed.
+    removed = sorted(set(previous) - set(manifest))
+    for filename in removed:
+        filepath = os.path.join(directory, filename)
+        if os.path.exists(filepath):
+            os.remove(filepath)
+        logging.debug("Removed " + filepath)
+
+    with open(manifest_path + ".partial", "w", encoding="utf-8") as manifest_file:
+        json.dump(manifest, manifest_file, indent=2, sort_keys=True)
+        manifest_file.write("\n")
+    os.replace(manifest_path + ".partial", manifest_path)
+    return written, len(removed)
+
+
+def generate_all_yaml(options):
+    """Exports every product listing in the DB to its own yaml file in the
+    options.filepath directory, named by listing_filename(). All products and
+    all overrides are fetched with one query each and grouped in memory.
+
+    Like generate_yaml(), rows sharing a label, version and variant make up
+    one listing, taking its header from the lowest product id. Listings are
+    only rewritten if their rows changed since the previous export."""
+    logging.info("Connecting to DB and querying all products and overrides...")
+    my_db = connect()
+
+    try:
+        try:
+            query = "select * from products order by id"
+            products = read_query(query, my_db, "generate lookup").getresult()
+
+            query = "select name, pkg_arch, product_arch, product from overrides"
+            overrides = read_query(query, my_db, "generate fetch").getresult()
+            logging.debug("Done.")
+        finally:
+            # Everything is read up front, so the connection isn't held while
+            # the listings are written.
+            my_db.close()
+
+        # Overrides are held as compact rows, which share their package names
+        # and take far less memory than the rows the DB returned.
+        overrides_by_id = {}
+        for override, compact in zip(overrides, compact_rows(overrides)):
+            overrides_by_id.setdefault(override[3], []).append(compact)
+        del overrides
+
+        listings = {}
+        for product in products:
+            filename = listing_filename(product[1], product[2], product[3])
+            header, rows, key = listings.setdefault(
+                filename, (product, [], product[1:4])
+            )
+            if key != product[1:4]:
+                raise ValueError(
+                    "Products {0} and {1} would both be written to {2}.".format(
+                        header[0], product[0], filename
+                    )
+                )
+            rows.extend(overrides_by_id.get(product[0], []))
+
+        logging.info("Dumping {0} listings to files...".format(len(listings)))
+        written, removed = mirror_listings(
+            {filename: listing[:2] for filename, listing in listings.items()},
+            options.filepath,
+            getattr(options, "full", False),
+            getattr(options, "canonical", False),
+        )
+        logging.info(
+            "Success! Yaml data of {0} listings is stored in {1}: {2} written, "
+            "{3} unchanged, {4} removed.".format(
+                len(listings),
+                options.filepath,
+                written,
+                len(listings) - written,
+                removed,
+            )
+        )
+
+    except Exception as _e:
+        logging.exception(_e)
+        sys.exit(1)
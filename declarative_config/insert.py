@@ -0,0 +1,268 @@
+"""Applying product listing files to the DB.
+
+Each listing is reconciled against the overrides of its product and applied
+in its own transaction. A batch of listings shares one validator and one DB
+connection, or is spread over a pool of worker processes with --jobs.
+"""
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import logging
+import multiprocessing.util
+from declarative_config.profiling import phase_timer, query_stats
+from declarative_config.reconcile import (
+    expand_package_listings,
+    listing_fingerprint,
+    reconcile_overrides,
+)
+from declarative_config.db import (
+    apply_override_changes,
+    connect,
+    get_listing_fingerprint,
+    get_product_overrides,
+    lock_product,
+    resolve_product_id,
+    selected_backend,
+    store_listing_fingerprint,
+    transaction,
+)
+from declarative_config.listings import (
+    YamlBadFormat,
+    load_listing,
+    load_validator,
+    validate_listing,
+)
+
+# The outcome of processing one listing file in a batch. error is None on success.
+ListingResult = namedtuple("ListingResult", ["filepath", "prod_id", "error"])
+
+
+def process_package_listings(desired, prod_id, commit, my_db, print_changes_only):
+    """
+    A helper function for process_prod_listings.
+    Takes as input the override keys expanded from the packages section
+    of a product/version/variant listing and generates appropriate
+    commands for the DB.
+
+    The yaml data (what we want to be the final dataset in the db) has
+    been expanded into a set of override keys by expand_package_listings(),
+    and the overrides already in the db under the id are normalized into
+    the same form. Set algebra then yields what has to be inserted, what
+    has to be deleted and what is already in place, and those sets are
+    handed to the DB layer.
+
+    prod_id is the ID of the product table entry that corresponds
+        to new overrides table entries.
+    """
+    with phase_timer.phase("reconcile"):
+        current = get_product_overrides(prod_id, commit, my_db, print_changes_only)
+        changes = reconcile_overrides(desired, current)
+    apply_override_changes(changes, prod_id, commit, my_db, print_changes_only)
+
+
+def insert_listing(yaml_data, commit, my_db, print_changes_only, force=False):
+    """Applies one already-validated product listing to the DB.
+
+    If the fingerprint stored for the product matches the listing, the product
+    is already up to date and nothing past that one lookup is executed, unless
+    force is set. Otherwise all of the queries for the listing run in a single
+    transaction, so a failed run never leaves a half-applied listing behind,
+    and under a per-product advisory lock, so concurrent runs can't interleave.
+    Returns the product ID.
+    """
+    logging.debug("Processing data")
+    prod_name = yaml_data.get("product_name")
+    version = yaml_data.get("version")
+    variant = yaml_data.get("variant")
+    allow_source_only = yaml_data.get("allow_source_only")
+    product = [prod_name, version, variant, allow_source_only]
+
+    with phase_timer.phase("reconcile"):
+        desired = expand_package_listings(yaml_data.get("packages", {}))
+        fingerprint = listing_fingerprint(product, desired)
+
+    if not force:
+        prod_id, stored_fingerprint = get_listing_fingerprint(
+            product, commit, my_db, print_changes_only
+        )
+        if stored_fingerprint == fingerprint:
+            logging.info(
+                "Product ID {0} already matches this listing, nothing to "
+                "do.".format(prod_id)
+            )
+            return prod_id
+
+    with transaction(commit, my_db, print_changes_only):
+        # Serialize against other runs applying the same product before
+        # reading anything, so the existence checks below can't race.
+        lock_product(product, commit, my_db, print_changes_only)
+
+        # Adding product entry must be done here to get the key id
+        # which is used for packages (in overrides table) immediately after
+        prod_id = resolve_product_id(product, commit, my_db, print_changes_only)
+
+        logging.debug("Got a product ID of {0}".format(prod_id))
+
+        process_package_listings(desired, prod_id, commit, my_db, print_changes_only)
+        store_listing_fingerprint(
+            prod_id, fingerprint, commit, my_db, print_changes_only
+        )
+
+    return prod_id
+
+
+def report_listing_results(results):
+    """Logs a per-file summary of a batch run. Returns True if every
+    listing was processed successfully."""
+    failures = [result for result in results if result.error]
+    if len(results) > 1:
+        logging.info(
+            "Processed {0} listings: {1} succeeded, {2} failed.".format(
+                len(results), len(results) - len(failures), len(failures)
+            )
+        )
+        for result in results:
+            if result.error:
+                logging.error("FAILED {0}: {1}".format(result.filepath, result.error))
+            else:
+                logging.info(
+                    "OK     {0} (product ID {1})".format(
+                        result.filepath, result.prod_id
+                    )
+                )
+    return not failures
+
+
+class ListingBatch:
+    """The state shared by every listing applied in a batch: one compiled
+    validator and one DB connection, which is only opened once a listing has
+    passed validation."""
+
+    def __init__(self, options):
+        self.options = options
+        self.yaml_validator = load_validator(options.schemapath, options.validator)
+        self.my_db = None
+
+    def apply(self, filepath):
+        """Loads, validates and inserts a single listing file.
+        Returns a ListingResult instead of raising."""
+        try:
+            yaml_data = load_listing(filepath)
+            validate_listing(yaml_data, self.yaml_validator)
+
+            if self.my_db is None:
+                # Connect to DB
+                logging.debug("Connecting to the database")
+                self.my_db = connect()
+
+            prod_id = insert_listing(
+                yaml_data,
+                self.options.commit,
+                self.my_db,
+                self.options.print_changes_only,
+                self.options.force,
+            )
+            return ListingResult(filepath, prod_id, None)
+
+        except YamlBadFormat as _e:
+            logging.critical("The yaml data failed validation against the schema.")
+            logging.critical("No database queries were executed.")
+            logging.debug(_e.errors)
+            return ListingResult(filepath, None, "failed schema validation")
+        except Exception as _e:
+            logging.exception(_e)
+            return ListingResult(filepath, None, str(_e))
+
+    def close(self):
+        """Closes the DB connection if one was opened."""
+        if self.my_db is not None:
+            self.my_db.close()
+            self.my_db = None
+
+
+class LogCollector(logging.Handler):
+    """Keeps formatted log messages in memory so a worker process can hand
+    them back to the parent, which logs them in a deterministic order."""
+
+    def __init__(self):
+        super().__init__()
+        self.setFormatter(logging.Formatter("%(message)s"))
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append((record.levelno, self.format(record)))
+
+
+# Per-process state of a --jobs worker, set up by _init_worker().
+_worker_state = {}
+
+
+def _init_worker(options, log_level):
+    """Gives a pool worker its own ListingBatch, and so its own DB connection,
+    and routes its logging into a LogCollector."""
+    log_collector = LogCollector()
+    root_logger = logging.getLogger()
+    root_logger.handlers = [log_collector]
+    root_logger.setLevel(log_level)
+
+    batch = ListingBatch(options)
+    multiprocessing.util.Finalize(batch, batch.close, exitpriority=10)
+    _worker_state["batch"] = batch
+    _worker_state["logs"] = log_collector
+
+
+def _apply_in_worker(filepath):
+    """Applies one listing inside a pool worker.
+    Returns its ListingResult along with the log messages, query stats and
+    phase times it produced."""
+    log_collector = _worker_state["logs"]
+    log_collector.messages = []
+    query_stats.kinds = {}
+    phase_timer.totals = {}
+    result = _worker_state["batch"].apply(filepath)
+    return result, log_collector.messages, (query_stats.kinds, phase_timer.totals)
+
+
+def apply_listings_in_parallel(filepaths, options):
+    """Spreads the listings over a pool of options.jobs worker processes, each
+    with its own DB connection. Every listing belongs to one product and is
+    applied in its own transaction, so they are independent of each other.
+
+    Logs are replayed and results returned in the order of filepaths,
+    regardless of which worker finished first. Listings for the same product
+    are not ordered against each other, so a batch should hold one listing
+    per product."""
+    jobs = min(options.jobs, len(filepaths))
+    logging.info("Applying {0} listings with {1} workers.".format(len(filepaths), jobs))
+    results = []
+    with ProcessPoolExecutor(
+        max_workers=jobs,
+        initializer=_init_worker,
+        initargs=(options, logging.getLogger().getEffectiveLevel()),
+    ) as executor:
+        for result, messages, stats in executor.map(_apply_in_worker, filepaths):
+            for level, message in messages:
+                logging.log(level, message)
+            query_stats.merge(stats[0])
+            phase_timer.merge(stats[1])
+            results.append(result)
+    return results
+
+
+def apply_listing_files(filepaths, options):
+    """Applies the given listing files, with a pool of workers if options.jobs
+    is above 1. Returns their ListingResults in the order of filepaths."""
+    if options.jobs > 1 and len(filepaths) > 1:
+        if selected_backend()[0] != "memory":
+            return apply_listings_in_parallel(filepaths, options)
+        # Each worker would write to an in-memory DB of its own, which is lost
+        # when the worker exits.
+        logging.warning(
+            "The memory backend can't be shared with --jobs workers. Applying "
+            "the listings one at a time."
+        )
+
+    batch = ListingBatch(options)
+    try:
+        return [batch.apply(filepath) for filepath in filepaths]
+    finally:
+        batch.close()
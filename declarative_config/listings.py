@@ -0,0 +1,292 @@
+"""Loading and validating product listing files.
+
+Listings are parsed with the libyaml-backed loader when it is available and
+validated with the compiled ListingValidator or with Cerberus. Listings that
+passed can be remembered in a ValidationCache so unchanged files are skipped.
+"""
+import glob
+import hashlib
+import logging
+import os
+import re
+import sys
+import time
+from cerberus import Validator
+import yaml
+from declarative_config.profiling import phase_timer
+from declarative_config.validator import ListingValidator, UnsupportedSchema
+
+# Use the libyaml-backed safe loader when PyYAML was built with it, it is
+# several times faster than the pure Python one and reads listings the same.
+try:
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
+
+
+class YamlBadFormat(Exception):
+    """Called when the validator fails the passed yaml data."""
+
+    def __init__(self, errors):
+        super().__init__()
+        self.errors = errors
+
+
+# The validation engines load_validator() can build.
+VALIDATOR_ENGINES = ("fast", "cerberus")
+
+# Where validate remembers the listings that passed, and how many it keeps.
+DEFAULT_CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+    "declarative_config",
+    "validation",
+)
+VALIDATION_CACHE_SIZE = 10000
+# How long the directory of another schema or engine is kept after its last
+# use, in seconds.
+VALIDATION_CACHE_MAX_AGE = 30 * 24 * 60 * 60
+
+# Compiled validators by schema path and engine, along with the schema file's
+# mtime when it was loaded. Filled in by load_validator().
+_validator_cache = {}
+
+
+def load_validator(schemapath, engine="fast"):
+    """Loads the validation schema and builds a validator from it.
+
+    The "fast" engine compiles the schema into a ListingValidator, falling back
+    to Cerberus if the schema uses rules it doesn't support, and the "cerberus"
+    engine always uses Cerberus. The validator is built once per process and
+    reused by later calls, until the schema file's mtime changes."""
+    cache_key = (os.path.abspath(schemapath), engine)
+    mtime = os.stat(schemapath).st_mtime_ns
+    cached = _validator_cache.get(cache_key)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    logging.debug("Loading data validator from {0}".format(schemapath))
+    with open(schemapath, encoding="ascii") as yaml_schema_file:
+        yaml_schema = yaml.load(yaml_schema_file, Loader=YamlLoader)
+
+    yaml_validator = None
+    if engine == "fast":
+        try:
+            yaml_validator = ListingValidator(yaml_schema)
+        except UnsupportedSchema as _e:
+            logging.warning(
+                "The schema uses {0}, which the fast validator does not "
+                "support. Falling back to Cerberus.".format(_e)
+            )
+    if yaml_validator is None:
+        yaml_validator = Validator(yaml_schema)
+
+    _validator_cache[cache_key] = (mtime, yaml_validator)
+    return yaml_validator
+
+
+def load_listing(filepath):
+    """Parses a listing file. This is the only place listings are read, the
+    resulting data is validated and applied in memory."""
+    logging.debug("Loading yaml data from {0}".format(filepath))
+    with phase_timer.phase("load"), open(filepath, encoding="ascii") as yaml_file:
+        return yaml.load(yaml_file, Loader=YamlLoader)
+
+
+def parse_listing(content):
+    """Parses the raw bytes of a listing file, for callers that already read
+    the file to hash it."""
+    with phase_timer.phase("load"):
+        return yaml.load(content.decode("ascii"), Loader=YamlLoader)
+
+
+class ValidationCache:
+    """An on-disk record of listing contents that already passed validation,
+    so unchanged listings can skip parsing and validation entirely.
+
+    Entries are empty files named after the sha256 of a listing's contents,
+    kept in a directory named after the sha256 of the schema file and the
+    validation engine. Changing the schema therefore starts a fresh directory.
+    prune() keeps this cache's own directory within its size, and removes the
+    directories of other schemas and engines once nothing used them for a
+    while, so old schemas don't pile up. A directory another run is still
+    using keeps getting touched, so it is never removed."""
+
+    # The names of the directories a ValidationCache creates.
+    DIRECTORY_NAME = re.compile(r"[0-9a-f]{64}")
+
+    def __init__(self, cache_dir, schemapath, engine):
+        with open(schemapath, "rb") as schema_file:
+            schema_hash = hashlib.sha256(schema_file.read())
+        schema_hash.update(engine.encode("ascii"))
+        self.cache_dir = cache_dir
+        self.path = os.path.join(cache_dir, schema_hash.hexdigest())
+
+    def _entry(self, content):
+        return os.path.join(self.path, hashlib.sha256(content).hexdigest())
+
+    def is_known_good(self, content):
+        """Returns True if listing content with these bytes passed before."""
+        try:
+            # Touching the entry keeps it from being evicted as unused.
+            os.utime(self._entry(content))
+            return True
+        except OSError:
+            return False
+
+    def remember(self, content):
+        """Records that listing content with these bytes passed validation."""
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            with open(self._entry(content), "a", encoding="ascii"):
+                pass
+        except OSError as _e:
+            logging.debug("Could not write to the validation cache: {0}".format(_e))
+
+    def prune(
+        self, max_entries=VALIDATION_CACHE_SIZE, max_age=VALIDATION_CACHE_MAX_AGE
+    ):
+        """Evicts the least recently used entries of this cache's directory
+        until at most max_entries are left, then removes the directories of
+        other schemas and engines that were not used for max_age seconds."""
+        self._evict_entries(max_entries)
+        self._remove_stale_directories(max_age)
+
+    def _evict_entries(self, max_entries):
+        try:
+            entries = []
+            for entry in os.scandir(self.path):
+                try:
+                    entries.append((entry.stat().st_mtime_ns, entry.path))
+                except FileNotFoundError:
+                    # Evicted by a run pruning at the same time.
+                    continue
+        except OSError as _e:
+            logging.debug("Could not prune the validation cache: {0}".format(_e))
+            return
+
+        if len(entries) <= max_entries:
+            return
+        entries.sort()
+        for _, path in entries[: len(entries) - max_entries]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            except OSError as _e:
+                logging.debug("Could not prune the validation cache: {0}".format(_e))
+                return
+
+    def _remove_stale_directories(self, max_age):
+        cutoff = time.time() - max_age
+        try:
+            directories = [
+                entry.path
+                for entry in os.scandir(self.cache_dir)
+                if entry.path != self.path
+                and self.DIRECTORY_NAME.fullmatch(entry.name)
+                and entry.is_dir(follow_symlinks=False)
+            ]
+        except OSError as _e:
+            logging.debug("Could not prune the validation cache: {0}".format(_e))
+            return
+
+        for directory in directories:
+            try:
+                # Entries are touched when used and the directory changes when
+                # one is added, so the newest of them is its last use.
+                last_used = max(
+                    [os.stat(directory).st_mtime]
+                    + [entry.stat().st_mtime for entry in os.scandir(directory)]
+                )
+                if last_used >= cutoff:
+                    continue
+                for entry in os.scandir(directory):
+                    os.remove(entry.path)
+                # Fails if a run added an entry meanwhile, which keeps it.
+                os.rmdir(directory)
+            except OSError as _e:
+                logging.debug("Could not prune the validation cache: {0}".format(_e))
+
+
+def open_validation_cache(options):
+    """Returns the ValidationCache to use for the given commandline options,
+    or None if caching is turned off."""
+    cache_dir = getattr(options, "cache_dir", None)
+    if not cache_dir:
+        return None
+    return ValidationCache(
+        cache_dir, options.schemapath, getattr(options, "validator", "fast")
+    )
+
+
+def validate_listing(data, yaml_validator):
+    """Validates already-parsed listing data against the given validator.
+    Raises YamlBadFormat if the data does not pass."""
+    logging.debug("Validating...")
+    # Validate prod listing data
+    with phase_timer.phase("validate"):
+        valid = yaml_validator.validate(data)
+    if not valid:
+        logging.critical("The yaml data failed validation against the schema.")
+        logging.critical("No database queries were executed.")
+        logging.debug(yaml_validator.errors)
+        raise YamlBadFormat(yaml_validator.errors)
+
+    logging.info("Pass")
+
+
+def validate_listing_file(filepath, schemapath, engine, validation_cache=None):
+    """Validates one listing file for validate_listings(), without logging.
+    Returns a (filepath, errors) pair where errors is None if the file passed,
+    the validator's errors if it failed validation, or a message if it
+    couldn't be validated at all."""
+    try:
+        with open(filepath, "rb") as yaml_file:
+            content = yaml_file.read()
+        if validation_cache is not None and validation_cache.is_known_good(content):
+            return filepath, None
+
+        yaml_validator = load_validator(schemapath, engine)
+        data = parse_listing(content)
+        with phase_timer.phase("validate"):
+            valid = yaml_validator.validate(data)
+        if not valid:
+            return filepath, yaml_validator.errors
+        if validation_cache is not None:
+            validation_cache.remember(content)
+        return filepath, None
+    except Exception as _e:
+        return filepath, str(_e)
+
+
+def expand_listing_paths(paths):
+    """Turns the paths given on the commandline into the list of listing files
+    to process. Directories expand to the yaml files directly inside them and
+    glob patterns expand to their matches, both in sorted order. Anything else
+    is passed through as-is so a missing file is reported like any other."""
+    filepaths = []
+    for path in paths:
+        if os.path.isdir(path):
+            filepaths.extend(
+                sorted(
+                    os.path.join(path, filename)
+                    for filename in os.listdir(path)
+                    if filename.endswith((".yaml", ".yml"))
+                    and os.path.isfile(os.path.join(path, filename))
+                )
+            )
+        elif glob.has_magic(path):
+            filepaths.extend(sorted(glob.glob(path, recursive=True)))
+        else:
+            filepaths.append(path)
+    return filepaths
+
+
+def find_listing_files(paths):
+    """Expands paths like expand_listing_paths(), exiting with an error if
+    they hold no listing files at all."""
+    filepaths = expand_listing_paths(paths)
+    if not filepaths:
+        logging.critical("No yaml files were found in the given paths.")
+        sys.exit(1)
+    return filepaths
@@ -0,0 +1,374 @@
+"""An in-memory stand-in for the compose database.
+
+It implements the subset of pg.DB that declarative config uses, query() and
+close(), for exactly the statements the tool sends. The products, overrides,
+tree_product_map, listing_fingerprints and listing_sync_state tables and the
+products_id_seq sequence are held in Python structures, with transactions,
+cursors and the row counts PostgreSQL returns. This lets the reconciliation
+logic be tested and benchmarked at memory speed without a running server.
+
+Every connection in a process shares one store, as they would share one
+database, until reset() is called.
+"""
+import itertools
+import re
+
+
+class UnsupportedStatement(Exception):
+    """Called when a statement is not one the in-memory backend understands."""
+
+
+# A literal in a VALUES list or a where clause: a quoted string or a bare word.
+_LITERAL = re.compile(r"'((?:[^']|'')*)'|([^\s,'()]+)")
+
+_PRODUCT_WHERE = re.compile(
+    r"label = '([^']*)'\s*and\s+version = '([^']*)'\s*and\s+variant = '([^']*)'"
+    r"(?:\s*and\s+allow_source_only = '([^']*)')?",
+    re.IGNORECASE,
+)
+
+
+def _literals(text):
+    """Splits the literals of one VALUES row or argument list into strings."""
+    return [
+        match.group(1).replace("''", "'")
+        if match.group(1) is not None
+        else match.group(2)
+        for match in _LITERAL.finditer(text)
+    ]
+
+
+def _rows(text):
+    """Splits a VALUES list into rows of literal strings."""
+    return [_literals(row) for row in re.findall(r"\(([^()]*)\)", text)]
+
+
+def _bool(literal):
+    """Reads a boolean literal the way PostgreSQL does."""
+    return literal.lower() in ("true", "t", "yes", "y", "on", "1")
+
+
+def _ids(text):
+    """Reads a comma separated list of integers."""
+    return [int(literal) for literal in _literals(text)]
+
+
+class MemoryQuery:
+    """The rows returned by a statement, like a pg.Query."""
+
+    def __init__(self, fields, rows):
+        self.fields = fields
+        self.rows = rows
+
+    def dictresult(self):
+        """Returns the rows as dictionaries from field name to value."""
+        return [dict(zip(self.fields, row)) for row in self.rows]
+
+    def getresult(self):
+        """Returns the rows as tuples."""
+        return list(self.rows)
+
+    def __len__(self):
+        return len(self.rows)
+
+
+class MemoryStore:
+    """The tables of one in-memory database."""
+
+    def __init__(self):
+        # id -> (id, label, version, variant, allow_source_only)
+        self.products = {}
+        # product id -> [(name, pkg_arch, product_arch, product, include)]
+        self.overrides = {}
+        # product id -> [tree_id]
+        self.tree_product_map = {}
+        # product id -> fingerprint
+        self.listing_fingerprints = {}
+        # source -> last_commit
+        self.listing_sync_state = {}
+        self.products_id_seq = 0
+
+    def snapshot(self):
+        """Copies the tables, so a transaction can be rolled back to them."""
+        return (
+            dict(self.products),
+            {prod_id: list(rows) for prod_id, rows in self.overrides.items()},
+            {prod_id: list(ids) for prod_id, ids in self.tree_product_map.items()},
+            dict(self.listing_fingerprints),
+            dict(self.listing_sync_state),
+            self.products_id_seq,
+        )
+
+    def restore(self, snapshot):
+        """Puts back the tables copied by snapshot()."""
+        (
+            self.products,
+            self.overrides,
+            self.tree_product_map,
+            self.listing_fingerprints,
+            self.listing_sync_state,
+            self.products_id_seq,
+        ) = snapshot
+
+    def find_products(self, label, version, variant, allow_source_only=None):
+        """Returns the products rows matching a label, version, variant and
+        optionally allow_source_only, ordered by id."""
+        return [
+            product
+            for prod_id, product in sorted(self.products.items())
+            if product[1:4] == (label, version, variant)
+            and (allow_source_only is None or product[4] == _bool(allow_source_only))
+        ]
+
+    def product_overrides(self, prod_ids):
+        """Returns the overrides rows of the given products, in insertion order."""
+        return [row for prod_id in prod_ids for row in self.overrides.get(prod_id, [])]
+
+
+class MemoryDB:
+    """A connection to a MemoryStore, with the query() and close() methods of
+    pg.DB."""
+
+    def __init__(self, store):
+        self.store = store
+        self._snapshot = None
+        self._cursors = {}
+        self._handlers = [
+            (re.compile(pattern, re.IGNORECASE | re.DOTALL), handler)
+            for pattern, handler in (
+                (r"(BEGIN|COMMIT|ROLLBACK)$", self._transaction),
+                (r"SELECT pg_try_advisory_xact_lock\(", self._try_lock),
+                (r"SELECT pg_advisory_xact_lock\(", self._lock),
+                (r"DECLARE (\w+) NO SCROLL CURSOR FOR (.*)$", self._declare),
+                (r"FETCH FORWARD (\d+) FROM (\w+)$", self._fetch),
+                (r"WITH existing AS", self._resolve_product),
+                (r"SELECT products\.id, listing_fingerprints", self._fingerprint),
+                (r"SELECT products\.id, label", self._products_state),
+                (r"(SELECT id|select \*) FROM products\s+WHERE", self._products),
+                (r"select \* from products order by id$", self._all_products),
+                (r"SELECT ([\w*, ]+?)\s+FROM overrides\b", self._overrides),
+                (r"DELETE from overrides\s+USING", self._delete_overrides),
+                (r"INSERT into overrides", self._insert_overrides),
+                (
+                    r"SELECT (tree_id, product_id|\*) FROM tree_product_map",
+                    self._tree_product_map,
+                ),
+                (r"INSERT into tree_product_map", self._insert_tree_product_map),
+                (r"INSERT into listing_fingerprints", self._store_fingerprint),
+                (r"SELECT last_commit FROM listing_sync_state", self._sync_state),
+                (r"INSERT into listing_sync_state", self._store_sync_state),
+                (r"DELETE FROM (\w+) WHERE (\w+) IN \((SELECT id .*)\)$", self._drop),
+            )
+        ]
+
+    def query(self, command):
+        """Executes a statement. Returns a MemoryQuery for statements returning
+        rows, the number of rows changed as a string for INSERT and DELETE,
+        and None otherwise, as pg.DB.query() does."""
+        command = command.strip()
+        for pattern, handler in self._handlers:
+            match = pattern.match(command)
+            if match:
+                return handler(match, command)
+        raise UnsupportedStatement(command)
+
+    def close(self):
+        """Ends the connection, rolling back any open transaction."""
+        if self._snapshot is not None:
+            self.store.restore(self._snapshot)
+            self._snapshot = None
+
+    # Transactions, locks and cursors
+
+    def _transaction(self, match, _command):
+        statement = match.group(1).upper()
+        if statement == "BEGIN":
+            self._snapshot = self.store.snapshot()
+        elif statement == "ROLLBACK" and self._snapshot is not None:
+            self.store.restore(self._snapshot)
+        if statement != "BEGIN":
+            self._snapshot = None
+            self._cursors = {}
+
+    def _try_lock(self, _match, _command):
+        # Every connection lives in this process, so nothing can hold a lock.
+        return MemoryQuery(["locked"], [(True,)])
+
+    def _lock(self, _match, _command):
+        return MemoryQuery(["pg_advisory_xact_lock"], [("",)])
+
+    def _declare(self, match, _command):
+        result = self.query(match.group(2))
+        self._cursors[match.group(1)] = (result.fields, iter(result.rows))
+
+    def _fetch(self, match, _command):
+        fields, rows = self._cursors[match.group(2)]
+        return MemoryQuery(fields, list(itertools.islice(rows, int(match.group(1)))))
+
+    # products
+
+    def _resolve_product(self, _match, command):
+        label, version, variant, allow_source_only = _PRODUCT_WHERE.search(
+            command
+        ).groups()
+        existing = self.store.find_products(label, version, variant, allow_source_only)
+        if existing:
+            return MemoryQuery(["id"], [(existing[0][0],)])
+
+        self.store.products_id_seq += 1
+        prod_id = self.store.products_id_seq
+        self.store.products[prod_id] = (
+            prod_id,
+            label,
+            version,
+            variant,
+            _bool(allow_source_only),
+        )
+        return MemoryQuery(["id"], [(prod_id,)])
+
+    def _fingerprint(self, _match, command):
+        products = self.store.find_products(*_PRODUCT_WHERE.search(command).groups())
+        return MemoryQuery(
+            ["id", "fingerprint"],
+            [
+                (product[0], self.store.listing_fingerprints.get(product[0]))
+                for product in products[:1]
+            ],
+        )
+
+    def _products_state(self, _match, command):
+        values = command.partition("IN (VALUES")[2]
+        keys = {
+            (label, version, variant, _bool(allow_source_only))
+            for label, version, variant, allow_source_only in _rows(values)
+        }
+        return MemoryQuery(
+            ["id", "label", "version", "variant", "allow_source_only", "fingerprint"],
+            [
+                product + (self.store.listing_fingerprints.get(product[0]),)
+                for _, product in sorted(self.store.products.items())
+                if product[1:] in keys
+            ],
+        )
+
+    def _products(self, _match, command):
+        products = self.store.find_products(*_PRODUCT_WHERE.search(command).groups())
+        if command.lower().startswith("select *"):
+            return MemoryQuery(
+                ["id", "label", "version", "variant", "allow_source_only"], products
+            )
+        return MemoryQuery(["id"], [(product[0],) for product in products])
+
+    def _all_products(self, _match, _command):
+        return MemoryQuery(
+            ["id", "label", "version", "variant", "allow_source_only"],
+            [product for _, product in sorted(self.store.products.items())],
+        )
+
+    # overrides
+
+    def _overrides(self, match, command):
+        where = re.search(
+            r"where product\s*(?:= '(\d+)'|in \(([^)]*)\))", command, re.I
+        )
+        if where is None:
+            prod_ids = list(self.store.overrides)
+        else:
+            prod_ids = [int(where.group(1))] if where.group(1) else _ids(where.group(2))
+        rows = self.store.product_overrides(prod_ids)
+
+        fields = ["name", "pkg_arch", "product_arch", "product", "include"]
+        if match.group(1) != "*":
+            columns = [fields.index(column) for column in match.group(1).split(", ")]
+            fields = [fields[column] for column in columns]
+            rows = [tuple(row[column] for column in columns) for row in rows]
+        if re.search(r"order by name", command, re.I):
+            rows.sort(key=lambda row: row[0])
+        return MemoryQuery(fields, rows)
+
+    def _delete_overrides(self, _match, command):
+        values, _, where = command.partition(") AS stale")
+        prod_id = int(re.search(r"overrides\.product = (\d+)", where).group(1))
+        stale = {tuple(row) for row in _rows(values.partition("(VALUES")[2])}
+        rows = self.store.overrides.get(prod_id, [])
+        # Only rows with include set are matched, as the statement says.
+        kept = [row for row in rows if not (row[4] is True and row[:3] in stale)]
+        self.store.overrides[prod_id] = kept
+        return str(len(rows) - len(kept))
+
+    def _insert_overrides(self, _match, command):
+        rows = _rows(command.partition("VALUES")[2])
+        for name, pkg_arch, product_arch, product, include in rows:
+            self.store.overrides.setdefault(int(product), []).append(
+                (name, pkg_arch, product_arch, int(product), _bool(include))
+            )
+        return str(len(rows))
+
+    # tree_product_map
+
+    def _tree_product_map(self, _match, command):
+        where = re.search(r"product_id\s*(?:= '(\d+)'|IN \(([^)]*)\))", command, re.I)
+        prod_ids = [int(where.group(1))] if where.group(1) else _ids(where.group(2))
+        return MemoryQuery(
+            ["tree_id", "product_id"],
+            [
+                (tree_id, prod_id)
+                for prod_id in prod_ids
+                for tree_id in self.store.tree_product_map.get(prod_id, [])
+            ],
+        )
+
+    def _insert_tree_product_map(self, _match, command):
+        rows = _rows(command.partition("VALUES")[2])
+        for tree_id, prod_id in rows:
+            self.store.tree_product_map.setdefault(int(prod_id), []).append(
+                int(tree_id)
+            )
+        return str(len(rows))
+
+    # listing_fingerprints and listing_sync_state
+
+    def _store_fingerprint(self, _match, command):
+        prod_id, fingerprint = _rows(command.partition("VALUES")[2])[0]
+        self.store.listing_fingerprints[int(prod_id)] = fingerprint
+        return "1"
+
+    def _sync_state(self, _match, command):
+        source = _literals(command.partition("source =")[2])[0]
+        last_commit = self.store.listing_sync_state.get(source)
+        return MemoryQuery(
+            ["last_commit"], [(last_commit,)] if last_commit is not None else []
+        )
+
+    def _store_sync_state(self, _match, command):
+        source, last_commit = _rows(command.partition("VALUES")[2])[0]
+        self.store.listing_sync_state[source] = last_commit
+        return "1"
+
+    # Deleting whole products, as the benchmarks do
+
+    def _drop(self, match, _command):
+        table, _column, products = match.groups()
+        prod_ids = [row[0] for row in self._products(None, products).rows]
+        rows = getattr(self.store, table)
+        removed = 0
+        for prod_id in prod_ids:
+            if prod_id in rows:
+                value = rows.pop(prod_id)
+                removed += len(value) if isinstance(value, list) else 1
+        return str(removed)
+
+
+# The store shared by every connection in this process.
+_store = MemoryStore()
+
+
+def connect(_db_settings=None):
+    """Opens a connection to the in-memory database of this process. The
+    connection settings of the other backends are not needed."""
+    return MemoryDB(_store)
+
+
+def reset():
+    """Empties the in-memory database of this process."""
+    _store.restore(MemoryStore().snapshot())
@@ -0,0 +1,224 @@
+"""Instrumentation for declarative config runs.
+
+PhaseTimer charges the wall time of a run to its phases, QueryStats groups
+the statements sent to the DB by kind, and the profile of a run can be written
+as pstats data or as collapsed stacks for flamegraph tools.
+"""
+from contextlib import contextmanager
+import json
+import math
+import os
+import pstats
+import re
+import time
+
+
+class PhaseTimer:
+    """The wall time spent in each phase of a run: load, validate, connect,
+    reconcile, read and write. Phases nest, and time is only charged to the
+    innermost one, so the totals never overlap."""
+
+    def __init__(self):
+        self.totals = {}
+        self._stack = []
+        self._since = None
+
+    def _charge(self, now):
+        name = self._stack[-1]
+        self.totals[name] = self.totals.get(name, 0.0) + now - self._since
+        self._since = now
+
+    @contextmanager
+    def phase(self, name):
+        """Charges the time spent in the enclosed block to the named phase."""
+        if self._stack:
+            self._charge(time.perf_counter())
+        self._stack.append(name)
+        self._since = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._charge(time.perf_counter())
+            self._stack.pop()
+
+    def merge(self, totals):
+        """Adds the phase totals of another PhaseTimer, such as the one of a
+        --jobs worker."""
+        for name, seconds in totals.items():
+            self.totals[name] = self.totals.get(name, 0.0) + seconds
+
+
+# The phases of everything run in this process.
+phase_timer = PhaseTimer()
+
+
+def _frame_label(func):
+    """Names a pstats function key as a collapsed stack frame."""
+    filename, line, name = func
+    if filename == "~":
+        label = name
+    else:
+        label = "{0} ({1}:{2})".format(name, os.path.basename(filename), line)
+    return label.replace(";", ",")
+
+
+def collapsed_stacks(stats, min_seconds=1e-6):
+    """Rebuilds approximate call stacks from the caller/callee edges of a
+    pstats.Stats, in the collapsed format read by flamegraph tools. Returns a
+    dictionary from the stack, frames joined by ";", to microseconds.
+
+    cProfile doesn't keep whole stacks, so the time of a function is split
+    between the stacks it was called from in proportion to each caller's
+    share of its cumulative time. Recursive calls and stacks below
+    min_seconds are left out."""
+    callees = {}
+    for func, (_cc, _nc, _tt, _ct, callers) in stats.stats.items():
+        for caller, edge in callers.items():
+            callees.setdefault(caller, {})[func] = edge
+
+    stacks = {}
+
+    def walk(func, path, own, cumulative):
+        frames = path + [_frame_label(func)]
+        stack = ";".join(frames)
+        stacks[stack] = stacks.get(stack, 0) + round(own * 1000000)
+        total = stats.stats[func][3]
+        scale = cumulative / total if total else 0
+        for callee, (_cc, _nc, tt, ct, *_rest) in callees.get(func, {}).items():
+            if ct * scale >= min_seconds and _frame_label(callee) not in frames:
+                walk(callee, frames, tt * scale, ct * scale)
+
+    for func, (_cc, _nc, tt, ct, callers) in sorted(stats.stats.items()):
+        if not callers:
+            walk(func, [], tt, ct)
+    return {stack: micros for stack, micros in stacks.items() if micros}
+
+
+def write_profile(profiler, filepath, profile_format):
+    """Writes what a cProfile.Profile collected to a file, either as pstats
+    data or as collapsed stacks for flamegraph tools."""
+    if profile_format == "pstats":
+        profiler.dump_stats(filepath)
+        return
+
+    stacks = collapsed_stacks(pstats.Stats(profiler))
+    with open(filepath, "w", encoding="utf-8") as profile_file:
+        for stack, micros in sorted(stacks.items()):
+            profile_file.write("{0} {1}\n".format(stack, micros))
+
+
+def report_phases(wall_seconds, filepath, stream):
+    """Writes the wall time of each phase of the run, along with the time
+    outside of any phase, to stream as JSON."""
+    phases = {
+        name: round(seconds, 6)
+        for name, seconds in sorted(
+            phase_timer.totals.items(), key=lambda item: -item[1]
+        )
+    }
+    report = {
+        "profile": filepath,
+        "wall_seconds": round(wall_seconds, 6),
+        "phases": phases,
+        # With --jobs the phases of all workers are summed, so they can add up
+        # to more than the wall time.
+        "other_seconds": round(max(0.0, wall_seconds - sum(phases.values())), 6),
+    }
+    json.dump(report, stream, indent=2)
+    stream.write("\n")
+
+
+# The kinds statements are grouped by in query_stats, matched against the
+# start of each statement in order.
+STATEMENT_KINDS = [
+    ("transaction", re.compile(r"(BEGIN|COMMIT|ROLLBACK)\b")),
+    ("product lock", re.compile(r"SELECT pg_(try_)?advisory_xact_lock")),
+    ("fingerprint lookup", re.compile(r"SELECT products\.id, listing_fingerprints")),
+    ("fingerprint store", re.compile(r"INSERT into listing_fingerprints")),
+    ("product lookup", re.compile(r"(WITH existing|SELECT (products\.)?id\b)")),
+    ("override lookup", re.compile(r"SELECT [\w*, ]+\s+FROM overrides")),
+    ("override insert", re.compile(r"INSERT into overrides")),
+    ("override delete", re.compile(r"DELETE from overrides")),
+    ("tree map lookup", re.compile(r"SELECT tree_id")),
+    ("tree map insert", re.compile(r"INSERT into tree_product_map")),
+    ("sync state", re.compile(r"(SELECT|INSERT).*listing_sync_state", re.DOTALL)),
+]
+
+
+def statement_kind(query):
+    """Names the kind of a statement for query_stats, or "other"."""
+    for kind, pattern in STATEMENT_KINDS:
+        if pattern.match(query):
+            return kind
+    return "other"
+
+
+def _percentile(ordered, fraction):
+    """The nearest-rank percentile of an ordered, non-empty list."""
+    return ordered[max(0, math.ceil(len(ordered) * fraction) - 1)]
+
+
+class QueryStats:
+    """The count, latencies and rows affected of the statements executed by
+    exec_query(), by statement kind."""
+
+    def __init__(self):
+        self.kinds = {}
+
+    def record(self, kind, seconds, rows):
+        """Adds one executed statement."""
+        entry = self.kinds.setdefault(kind, {"latencies": [], "rows": 0})
+        entry["latencies"].append(seconds)
+        entry["rows"] += rows
+
+    def merge(self, kinds):
+        """Adds the statements recorded by another QueryStats, such as the one
+        of a --jobs worker."""
+        for kind, other in kinds.items():
+            entry = self.kinds.setdefault(kind, {"latencies": [], "rows": 0})
+            entry["latencies"].extend(other["latencies"])
+            entry["rows"] += other["rows"]
+
+    def summary(self):
+        """Returns a dictionary from statement kind to its count, rows, and
+        total and percentile latencies in milliseconds, busiest kind first."""
+        summary = {}
+        for kind, entry in sorted(
+            self.kinds.items(), key=lambda item: -sum(item[1]["latencies"])
+        ):
+            ordered = sorted(entry["latencies"])
+            summary[kind] = {
+                "count": len(ordered),
+                "rows": entry["rows"],
+                "total_ms": round(sum(ordered) * 1000, 3),
+                "p50_ms": round(_percentile(ordered, 0.5) * 1000, 3),
+                "p95_ms": round(_percentile(ordered, 0.95) * 1000, 3),
+                "p99_ms": round(_percentile(ordered, 0.99) * 1000, 3),
+                "max_ms": round(ordered[-1] * 1000, 3),
+            }
+        return summary
+
+    def report(self, stats_format, stream):
+        """Writes the summary to stream, as a table or as JSON."""
+        summary = self.summary()
+        if stats_format == "json":
+            json.dump(summary, stream, indent=2)
+            stream.write("\n")
+            return
+
+        columns = ("count", "rows", "total_ms", "p50_ms", "p95_ms", "p99_ms", "max_ms")
+        stream.write(
+            "{0:<20}".format("statement")
+            + "".join("{0:>11}".format(column) for column in columns)
+            + "\n"
+        )
+        for kind, entry in summary.items():
+            stream.write(
+                "{0:<20}".format(kind)
+                + "".join("{0:>11}".format(entry[column]) for column in columns)
+                + "\n"
+            )
+
+
+# Every statement executed by exec_query() in this process.
+query_stats = QueryStats()
@@ -0,0 +1,153 @@
+"""The overrides of a product listing as a set, and their reconciliation
+against the overrides in the DB.
+
+Overrides are held as compact (name, pkg_arch, product_arch, include) keys, so
+the changes a listing needs are plain set differences.
+"""
+from collections import namedtuple
+import hashlib
+import json
+import sys
+
+# The arches overrides are held with, as codes indexing this table. It is in
+# alphabetical order, so overrides sort the same by code as by arch name.
+# Arches missing from it are appended when first seen, which makes codes only
+# meaningful within one process: overrides are decoded before anything about
+# them leaves it.
+ARCH_TABLE = [
+    "aarch64",
+    "i386",
+    "ia64",
+    "noarch",
+    "ppc",
+    "ppc64",
+    "ppc64le",
+    "s390",
+    "s390x",
+    "src",
+    "x86_64",
+]
+ARCH_CODES = {arch: code for code, arch in enumerate(ARCH_TABLE)}
+NOARCH = ARCH_CODES["noarch"]
+SRC = ARCH_CODES["src"]
+
+
+def arch_code(arch):
+    """Returns the code of an arch in ARCH_TABLE, adding it if it is new."""
+    code = ARCH_CODES.get(arch)
+    if code is None:
+        code = ARCH_CODES[arch] = len(ARCH_TABLE)
+        ARCH_TABLE.append(arch)
+    return code
+
+
+def encode_override(name, pkg_arch, product_arch, include=True):
+    """Returns the compact key of an override: a (name, pkg_arch,
+    product_arch, include) tuple with the package name interned, so every
+    override of a package shares one string, and the arches as ARCH_TABLE
+    codes."""
+    return (
+        sys.intern(name),
+        arch_code(pkg_arch),
+        arch_code(product_arch),
+        bool(include),
+    )
+
+
+def decode_override(override):
+    """Turns a compact override key back into (name, pkg_arch, product_arch,
+    include) with the arches spelled out."""
+    name, pkg_arch, product_arch, include = override
+    return (name, ARCH_TABLE[pkg_arch], ARCH_TABLE[product_arch], include)
+
+
+def compact_rows(rows):
+    """Turns (name, pkg_arch, product_arch, ...) overrides rows from the DB into
+    compact (name, pkg_arch, product_arch) tuples for generate, interned and
+    coded like encode_override()."""
+    for row in rows:
+        yield (sys.intern(row[0]), arch_code(row[1]), arch_code(row[2]))
+
+
+# The three outcomes of reconciling a listing against the overrides in the DB.
+# Each field is a set of compact override keys, as made by encode_override().
+OverrideChanges = namedtuple("OverrideChanges", ["to_insert", "to_delete", "unchanged"])
+
+
+def expand_package_listings(packages):
+    """Expands the packages section of a yaml listing into the set of
+    overrides it describes.
+
+    Each override is a compact (name, pkg_arch, product_arch, include) key, as
+    made by encode_override(), which makes them hashable and directly
+    comparable to normalize_overrides() output.
+    """
+    overrides = set()
+    for pkg_name, offerings in (packages or {}).items():
+        name = sys.intern(pkg_name)
+        for prod_arch in offerings.get("noarch", []):
+            overrides.add((name, NOARCH, arch_code(prod_arch), True))
+        # If src is present, it is a list of prod arches for which the package
+        # is being offered as source.
+        for prod_arch in offerings.get("src", []):
+            overrides.add((name, SRC, arch_code(prod_arch), True))
+        for pkg_arch in offerings.get("arch", []):
+            code = arch_code(pkg_arch)
+            overrides.add((name, code, code, True))
+        for offering in offerings.get("multilib", []):
+            for pkg_arch, prod_arch in offering.items():
+                overrides.add((name, arch_code(pkg_arch), arch_code(prod_arch), True))
+    return overrides
+
+
+def normalize_overrides(rows):
+    """Turns (name, pkg_arch, product_arch, include, ...) overrides rows from
+    the DB into the same set of compact keys as expand_package_listings().
+    Exclusion overrides keep include unset, so reconcile_overrides() can tell
+    them apart."""
+    return {encode_override(row[0], row[1], row[2], bool(row[3])) for row in rows}
+
+
+def reconcile_overrides(desired, current):
+    """Compares the overrides a listing wants with those already in the DB.
+
+    Both arguments are sets of override keys. Returns an OverrideChanges whose
+    to_insert holds keys only in the listing, to_delete holds keys only in the
+    DB, and unchanged holds keys present in both.
+
+    Exclusion overrides (include unset) can't be written in a listing. They are
+    never deleted, and a listing key the DB excludes is not inserted next to
+    its exclusion but counted as unchanged.
+    """
+    included = {key for key in current if key[3]}
+    excluded = {key[:3] for key in current if not key[3]}
+    to_insert = {key for key in desired - included if key[:3] not in excluded}
+    return OverrideChanges(
+        to_insert=to_insert,
+        to_delete=included - desired,
+        unchanged=desired - to_insert,
+    )
+
+
+def product_key(product):
+    """Normalizes a product to the hashable form it is stored in: label,
+    version and variant as the strings the DB holds, and allow_source_only as
+    a bool.
+
+    product should come in as a list whose first item is the label,
+    second is version, third is variant, and fourth is allow_source_only."""
+    return (str(product[0]), str(product[1]), str(product[2]), bool(product[3]))
+
+
+def listing_fingerprint(product, desired):
+    """Computes a canonical fingerprint of a normalized listing: its product
+    fields and its set of override keys. Listings that only differ in the
+    order of packages or arches get the same fingerprint.
+
+    product should come in as a list whose first item is the label,
+    second is version, third is variant, and fourth is allow_source_only."""
+    canonical = json.dumps(
+        [[str(field) for field in product], sorted(map(decode_override, desired))],
+        separators=(",", ":"),
+    )
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
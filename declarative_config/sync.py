@@ -0,0 +1,165 @@
+"""Syncing the listings of a git checkout to the DB.
+
+Only the listings that changed since the commit the directory was last synced
+from are applied, and the new commit is recorded once they all succeeded.
+"""
+import logging
+import sys
+import os
+import subprocess
+import yaml
+from declarative_config.db import (
+    connect,
+    get_last_synced_commit,
+    log_commit_mode,
+    log_nothing_committed,
+    store_last_synced_commit,
+)
+from declarative_config.listings import YamlLoader, expand_listing_paths
+from declarative_config.insert import apply_listing_files, report_listing_results
+
+
+def run_git(directory, *args):
+    """Runs a git command in the given directory and returns its output."""
+    return subprocess.run(
+        ["git", "-C", directory] + list(args),
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+
+
+def is_listing_filename(path):
+    """Returns True for a yaml file directly inside the synced directory, which
+    is what expand_listing_paths() picks up from a directory."""
+    return "/" not in path and path.endswith((".yaml", ".yml"))
+
+
+def changed_listings(directory, since):
+    """Asks git which listings in a directory changed between the since commit
+    and HEAD. Returns a (changed, deleted) pair of lists of listing paths.
+    A renamed listing counts as deleted under its old name and changed under
+    the new one."""
+    changed = []
+    deleted = []
+    output = run_git(
+        directory,
+        "diff",
+        "--name-status",
+        "--no-renames",
+        "--relative",
+        since,
+        "HEAD",
+        "--",
+        ".",
+    )
+    for line in output.splitlines():
+        status, path = line.split("\t", 1)
+        if not is_listing_filename(path):
+            continue
+        if status == "D":
+            deleted.append(os.path.join(directory, path))
+        else:
+            changed.append(os.path.join(directory, path))
+    return sorted(changed), sorted(deleted)
+
+
+def report_deleted_listing(directory, filepath, since):
+    """Logs a listing that was deleted since the last sync, naming the product
+    it described so it can be retired."""
+    try:
+        content = run_git(
+            directory, "show", "{0}:./{1}".format(since, os.path.basename(filepath))
+        )
+        yaml_data = yaml.load(content, Loader=YamlLoader)
+        logging.warning(
+            "{0} was deleted. Product {1}, version {2}, variant {3} should be "
+            "retired.".format(
+                filepath,
+                yaml_data.get("product_name"),
+                yaml_data.get("version"),
+                yaml_data.get("variant"),
+            )
+        )
+    except Exception as _e:
+        logging.debug(_e)
+        logging.warning(
+            "{0} was deleted. Its product should be retired.".format(filepath)
+        )
+
+
+def sync_listings(options):
+    """Applies only the listings in a git checkout directory that changed since
+    the commit it was last synced from, then records HEAD as the new last
+    synced commit. Listings deleted since then are reported so their products
+    can be retired. The first sync, or one with --full, applies every listing.
+
+    Listings are read from the working tree, so a checkout with uncommitted
+    changes is refused: they would be applied and recorded as HEAD.
+    """
+    directory = options.directory
+    log_commit_mode(options.commit)
+
+    try:
+        head = run_git(directory, "rev-parse", "HEAD").strip()
+        source = run_git(directory, "rev-parse", "--show-prefix").strip() or "."
+        if run_git(directory, "status", "--porcelain", "--", "."):
+            logging.critical(
+                "{0} has uncommitted changes. Commit or stash them first, so the "
+                "listings applied are the ones at {1}.".format(directory, head)
+            )
+            sys.exit(1)
+
+        my_db = connect()
+        try:
+            since = None
+            if not options.full:
+                since = get_last_synced_commit(
+                    source, options.commit, my_db, options.print_changes_only
+                )
+
+            deleted = []
+            if since is None:
+                logging.info("Applying every listing in {0}.".format(directory))
+                filepaths = expand_listing_paths([directory])
+            else:
+                try:
+                    filepaths, deleted = changed_listings(directory, since)
+                    logging.info(
+                        "{0} listings changed and {1} were deleted in {2} "
+                        "since {3}.".format(
+                            len(filepaths), len(deleted), directory, since
+                        )
+                    )
+                except subprocess.CalledProcessError as _e:
+                    logging.warning(
+                        "Could not diff against the last synced commit {0} "
+                        "({1}). Applying every listing.".format(
+                            since, _e.stderr.strip()
+                        )
+                    )
+                    filepaths = expand_listing_paths([directory])
+
+            for filepath in deleted:
+                report_deleted_listing(directory, filepath, since)
+
+            results = apply_listing_files(filepaths, options)
+            succeeded = report_listing_results(results)
+            if succeeded and since != head:
+                store_last_synced_commit(
+                    source, head, options.commit, my_db, options.print_changes_only
+                )
+        finally:
+            my_db.close()
+    except Exception as _e:
+        logging.exception(_e)
+        sys.exit(1)
+
+    log_nothing_committed(options.commit)
+
+    if not succeeded:
+        logging.critical(
+            "Some listings failed, so the last synced commit was not moved to "
+            "{0}.".format(head)
+        )
+        sys.exit(1)
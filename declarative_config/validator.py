@@ -0,0 +1,246 @@
+"""A validator compiled from the listing schema.
+
+ListingValidator checks listings against the same subset of Cerberus rules the
+listing schema uses and reports errors in Cerberus' format, at a fraction of
+the cost of Cerberus' generic validation. Schemas using any other rule raise
+UnsupportedSchema, so the caller can fall back to Cerberus.
+"""
+from collections.abc import Mapping, Sequence
+import re
+
+# The schema rules the listing validator knows how to compile. A schema using
+# anything else is left to Cerberus.
+_supported_schema_rules = frozenset(
+    [
+        "type",
+        "required",
+        "nullable",
+        "regex",
+        "min",
+        "max",
+        "schema",
+        "keysrules",
+        "valuesrules",
+    ]
+)
+
+# What each schema type name accepts, following Cerberus' type definitions.
+_schema_types = {
+    "string": lambda value: isinstance(value, str),
+    "float": lambda value: isinstance(value, (float, int)),
+    "integer": lambda value: isinstance(value, int) and not isinstance(value, bool),
+    "boolean": lambda value: isinstance(value, bool),
+    "dict": lambda value: isinstance(value, Mapping),
+    "list": lambda value: isinstance(value, Sequence) and not isinstance(value, str),
+}
+
+# A regex that is nothing but a list of names, like the arch regexes.
+_name_alternation = re.compile(r"\w+(\|\w+)*")
+
+
+class UnsupportedSchema(Exception):
+    """Called when a schema uses rules the listing validator can't compile."""
+
+
+def _merge_errors(errors):
+    """Orders the errors for one field the way Cerberus reports them: plain
+    messages first, then at most one dict holding all nested errors."""
+    messages = [error for error in errors if not isinstance(error, dict)]
+    nested = {}
+    for error in errors:
+        if isinstance(error, dict):
+            for key, key_errors in error.items():
+                nested.setdefault(key, []).extend(key_errors)
+    return messages + [nested] if nested else messages
+
+
+def _compile_regex(pattern):
+    """Compiles a regex rule. Patterns that are only a list of names are checked
+    with string comparisons instead, giving the same verdicts as the regex."""
+    message = "value does not match regex '{0}'".format(pattern)
+
+    if _name_alternation.fullmatch(pattern):
+        # The $ Cerberus appends only anchors the last name, so the others
+        # match any value starting with them, like s390xyz does s390.
+        *prefixes, last = pattern.split("|")
+        prefixes = tuple(prefixes)
+        exact = frozenset([last, last + "\n"])
+
+        def check_names(value):
+            if (
+                isinstance(value, str)
+                and value not in exact
+                and not value.startswith(prefixes)
+            ):
+                return [message]
+            return []
+
+        return check_names
+
+    # Cerberus anchors the end of every pattern the same way.
+    compiled = re.compile(pattern if pattern.endswith("$") else pattern + "$")
+
+    def check_regex(value):
+        if isinstance(value, str) and not compiled.match(value):
+            return [message]
+        return []
+
+    return check_regex
+
+
+def _compile_bound(constraint, is_min):
+    """Compiles a min or max rule."""
+    message = "{0} value is {1}".format("min" if is_min else "max", constraint)
+
+    def check_bound(value):
+        if (value < constraint) if is_min else (value > constraint):
+            return [message]
+        return []
+
+    return check_bound
+
+
+def _compile_schema(schema, type_name):
+    """Compiles a schema rule, which applies to every item of a list or to the
+    fields of a dict depending on the type of the field."""
+    if type_name == "list":
+        check_item = _compile_field(schema)
+
+        def check_items(items):
+            nested = {}
+            for index, item in enumerate(items):
+                item_errors = check_item(item)
+                if item_errors:
+                    nested[index] = item_errors
+            return [nested] if nested else []
+
+        return check_items
+
+    if type_name == "dict":
+        check_document = _compile_document(schema)
+
+        def check_subdocument(mapping):
+            nested = check_document(mapping)
+            return [nested] if nested else []
+
+        return check_subdocument
+
+    raise UnsupportedSchema("schema rule on a field of type {0}".format(type_name))
+
+
+def _compile_mapping_rules(keysrules, valuesrules):
+    """Compiles the keysrules and valuesrules of a dict field. Errors for a key
+    and for its value are reported together under that key."""
+    check_key = _compile_field(keysrules) if keysrules else None
+    check_value = _compile_field(valuesrules) if valuesrules else None
+
+    def check_mapping(mapping):
+        nested = {}
+        for key, value in mapping.items():
+            entry_errors = []
+            if check_key is not None:
+                entry_errors.extend(check_key(key))
+            if check_value is not None:
+                entry_errors.extend(check_value(value))
+            if entry_errors:
+                nested[key] = entry_errors
+        return [nested] if nested else []
+
+    return check_mapping
+
+
+def _compile_field(rules):
+    """Compiles the rules of one field into a function returning the list of
+    errors for a value, which is empty when the value passes."""
+    if not isinstance(rules, dict):
+        raise UnsupportedSchema("rules must be a dict, got {0!r}".format(rules))
+    unsupported = set(rules) - _supported_schema_rules
+    if unsupported:
+        raise UnsupportedSchema("rules {0}".format(", ".join(sorted(unsupported))))
+
+    type_name = rules.get("type")
+    if type_name is not None and type_name not in _schema_types:
+        raise UnsupportedSchema("type {0}".format(type_name))
+    type_check = _schema_types.get(type_name)
+    nullable = rules.get("nullable", False)
+
+    checks = []
+    for rule, constraint in rules.items():
+        if rule == "regex":
+            checks.append(_compile_regex(constraint))
+        elif rule in ("min", "max"):
+            checks.append(_compile_bound(constraint, rule == "min"))
+        elif rule == "schema":
+            checks.append(_compile_schema(constraint, type_name))
+    if "keysrules" in rules or "valuesrules" in rules:
+        if type_name != "dict":
+            raise UnsupportedSchema("keysrules or valuesrules outside of a dict")
+        checks.append(
+            _compile_mapping_rules(rules.get("keysrules"), rules.get("valuesrules"))
+        )
+
+    def check_field(value):
+        if value is None:
+            return [] if nullable else ["null value not allowed"]
+        if type_check is not None and not type_check(value):
+            # A value of the wrong type isn't checked any further.
+            return ["must be of {0} type".format(type_name)]
+        errors = []
+        for check in checks:
+            errors.extend(check(value))
+        return _merge_errors(errors)
+
+    return check_field
+
+
+def _compile_document(schema):
+    """Compiles a mapping of field names to rules into a function returning
+    the errors of a document as a dict, which is empty when it passes."""
+    if not isinstance(schema, dict):
+        raise UnsupportedSchema("schema must be a dict, got {0!r}".format(schema))
+    fields = {name: _compile_field(rules) for name, rules in schema.items()}
+    required = [name for name, rules in schema.items() if rules.get("required")]
+
+    def check_document(document):
+        errors = {}
+        for name, value in document.items():
+            check_field = fields.get(name)
+            if check_field is None:
+                errors[name] = ["unknown field"]
+                continue
+            field_errors = check_field(value)
+            if field_errors:
+                errors[name] = field_errors
+        for name in required:
+            if name not in document:
+                errors[name] = ["required field"]
+        return errors
+
+    return check_document
+
+
+class ListingValidator:
+    """A validator compiled once from the listing schema into plain Python
+    checks, instead of walking the schema for every value like Cerberus does.
+
+    It supports the subset of Cerberus rules the listing schema uses and
+    reports errors in the same structure, so it can stand in for
+    cerberus.Validator. Raises UnsupportedSchema for any other rule."""
+
+    def __init__(self, schema):
+        self._check_document = _compile_document(schema)
+        self.errors = {}
+
+    def validate(self, document):
+        """Validates a document, returning True if it passes. The errors of the
+        last validation are kept in the errors attribute."""
+        if document is None:
+            raise ValueError("document is missing")
+        if not isinstance(document, Mapping):
+            raise ValueError("'{0}' is not a document, must be a dict".format(document))
+        self.errors = self._check_document(document)
+        return not self.errors
+
+    def __call__(self, document):
+        # Cerberus validators can be called directly too.
+        return self.validate(document)
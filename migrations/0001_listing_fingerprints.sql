@@ -0,0 +1,6 @@
+-- The fingerprint of the listing last applied to each product, so inserting
+-- an unchanged listing can be skipped. Needed by insert, plan and apply.
+CREATE TABLE IF NOT EXISTS listing_fingerprints (
+    product_id INTEGER PRIMARY KEY,
+    fingerprint VARCHAR(64) NOT NULL
+);
@@ -0,0 +1,6 @@
+-- The git commit the listings in each directory were last synced from, so
+-- sync only applies the listings that changed since. Needed by sync.
+CREATE TABLE IF NOT EXISTS listing_sync_state (
+    source VARCHAR PRIMARY KEY,
+    last_commit VARCHAR(40) NOT NULL
+);
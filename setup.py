@@ -18,7 +18,6 @@ setup(
             "",
             [
                 "yaml_schema.yaml",
-                "declarative_config/declarative_config.py",
                 "db_connections.conf",
             ],
         )
@@ -0,0 +1,49 @@
+"""Testing for the benchmarks."""
+import json
+import pytest
+from declarative_config.db import DB_BACKENDS
+from declarative_config.listings import (
+    VALIDATOR_ENGINES,
+    load_validator,
+    validate_listing,
+)
+from declarative_config import benchmark
+
+
+def test_benchmark_listings_are_valid(capsys):
+    """Tests that the synthetic benchmark listings pass validation, are the same
+    for the same seed, and that the in-memory benchmark reports every
+    phase."""
+    listing = benchmark.synthetic_listing(200, seed=1)
+    assert listing == benchmark.synthetic_listing(200, seed=1)
+    assert len(listing["packages"]) == 200
+    for engine in VALIDATOR_ENGINES:
+        validator = load_validator("yaml_schema.yaml", engine)
+        validate_listing(listing, validator)
+    assert len(benchmark.trimmed_listing(listing)["packages"]) == 20
+
+    benchmark.main(["--sizes", "5,20", "--repeat", "1"])
+    report = json.loads(capsys.readouterr().out)
+    assert report["backend"] == "none"
+    assert list(report["sizes"]) == ["5", "20"]
+    assert set(report["sizes"]["20"]["seconds"]) == {
+        "parse",
+        "validate",
+        "reconcile",
+        "generate",
+    }
+
+
+def test_benchmark_refuses_production(monkeypatch, caplog):
+    """Tests that the benchmark won't run its DB phases, which delete products,
+    against the production database."""
+    monkeypatch.setenv("PROD_DB", "true")
+
+    def connect(*_args):
+        raise AssertionError("The benchmark connected to the DB.")
+
+    monkeypatch.setitem(DB_BACKENDS, "postgres", connect)
+    with pytest.raises(SystemExit) as excinfo:
+        benchmark.main(["--sizes", "5", "--backend", "postgres"])
+    assert excinfo.value.code == 1
+    assert "Refusing to benchmark the production database" in caplog.text
@@ -0,0 +1,137 @@
+"""Testing for planning and applying changesets."""
+import io
+import pytest
+from declarative_config.changeset import (
+    plan_product,
+    product_state_digest,
+    write_changeset_sql,
+)
+from declarative_config.db import connect, get_products_state
+from declarative_config.declarative_config import main
+from declarative_config.generate import write_listing
+from declarative_config.listings import load_listing
+from declarative_config.reconcile import (
+    decode_override,
+    encode_override,
+    expand_package_listings,
+    listing_fingerprint,
+    product_key,
+)
+from declarative_config import memory_db
+
+
+def test_plan_product_records():
+    """Tests that planning a product records the state it was planned against
+    and only the overrides and tree mappings that differ, and that an up to
+    date product is left out of the changeset."""
+    key = product_key(["RHEL-4", 6.0, "AS", False])
+    assert key == ("RHEL-4", "6.0", "AS", False)
+    desired = expand_package_listings(
+        load_listing("tests/data/listing_5_part1.yaml")["packages"]
+    )
+    fingerprint = listing_fingerprint(list(key), desired)
+    stale = encode_override("stale", "src", "x86_64")
+    state = {
+        "id": 3,
+        "fingerprint": None,
+        "overrides": set(list(desired)[1:]) | {stale},
+        "tree_ids": set(),
+    }
+
+    records = plan_product(key, desired, fingerprint, state)
+    assert records[0]["op"] == "product"
+    assert records[0]["id"] == 3
+    assert records[0]["state"] == product_state_digest(state)
+    assert [r["override"] for r in records if r["op"] == "insert_override"] == [
+        list(decode_override(list(desired)[0]))
+    ]
+    assert [r["override"] for r in records if r["op"] == "delete_override"] == [
+        list(decode_override(stale))
+    ]
+    assert {r["tree_id"] for r in records if r["op"] == "insert_tree_product_map"}
+
+    absent = plan_product(key, desired, fingerprint, None)
+    assert absent[0]["state"] == "absent"
+    assert len([r for r in absent if r["op"] == "insert_override"]) == len(desired)
+
+    state["overrides"] = set(desired)
+    state["tree_ids"] = {r["tree_id"] for r in absent[1:] if "tree_id" in r}
+    drifted = product_state_digest(state)
+    assert drifted != records[0]["state"]
+    state["fingerprint"] = fingerprint
+    assert not plan_product(key, desired, fingerprint, state)
+
+
+def test_changeset_sql_script():
+    """Tests that a planned changeset is written as a single-transaction psql
+    script with one set-based statement per kind of change, which resolves
+    the product id itself."""
+    key = product_key(["RHEL-4", 6.0, "AS", False])
+    desired = expand_package_listings(
+        load_listing("tests/data/listing_5_part1.yaml")["packages"]
+    )
+    fingerprint = listing_fingerprint(list(key), desired)
+    state = {
+        "id": 3,
+        "fingerprint": None,
+        "overrides": {encode_override("stale", "src", "x86_64")},
+        "tree_ids": set(),
+    }
+    records = plan_product(key, desired, fingerprint, state)
+
+    script = io.StringIO()
+    write_changeset_sql(script, ["listing.yaml"], records)
+    lines = script.getvalue().splitlines()
+    assert lines[:2] == [
+        "-- Generated by declarative_config plan from:",
+        "--   listing.yaml",
+    ]
+    assert "\\set ON_ERROR_STOP on" in lines
+    assert lines.count("BEGIN;") == 1
+    assert lines[-1] == "COMMIT;"
+    assert sum(line.endswith("\\gset product_") for line in lines) == 1
+    assert sum(line.startswith("INSERT into overrides") for line in lines) == 1
+    assert sum(line.startswith("DELETE from overrides") for line in lines) == 1
+    assert "    ('stale', 'src', 'x86_64')" in lines
+    assert (
+        sum(":product_id" in line for line in lines)
+        == len(desired)
+        + len([r for r in records if r["op"] == "insert_tree_product_map"])
+        + 2
+    )
+
+
+def test_apply_changeset_refuses_drift(tmp_path, monkeypatch, caplog):
+    """Tests that apply executes a planned changeset, after which the same
+    listing plans no changes, and that applying the changeset again is
+    refused because the DB no longer matches the state it was planned
+    against."""
+    monkeypatch.setenv("DB_BACKEND", "memory")
+    memory_db.reset()
+    listing = load_listing("tests/data/listing_5_part1.yaml")
+    listing["variant"] = "Changeset"
+    listing_path = str(tmp_path / "listing.yaml")
+    write_listing(listing, listing_path)
+    changeset = str(tmp_path / "changes.jsonl")
+
+    main(["plan", listing_path, "-o", changeset])
+    main(["apply", changeset, "--commit"])
+    my_db = connect()
+    key = product_key([listing["product_name"], listing["version"], "Changeset", False])
+    state = get_products_state([key], True, my_db, False)[key]
+    assert state["overrides"] == expand_package_listings(listing["packages"])
+
+    replanned = str(tmp_path / "replanned.jsonl")
+    main(["plan", listing_path, "-o", replanned])
+    with open(replanned, encoding="utf-8") as changeset_file:
+        assert len(changeset_file.readlines()) == 1
+
+    caplog.clear()
+    with pytest.raises(SystemExit) as excinfo:
+        main(["apply", changeset, "--commit"])
+    assert excinfo.value.code == 1
+    critical = [record for record in caplog.records if record.levelname == "CRITICAL"]
+    assert len(critical) == 1
+    assert "The DB changed since the changeset was planned" in critical[0].message
+    assert not any(record.exc_info for record in caplog.records)
+    assert get_products_state([key], True, my_db, False)[key] == state
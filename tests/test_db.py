@@ -0,0 +1,147 @@
+"""Testing for the DB interfacing functions."""
+import pytest
+from declarative_config.db import (
+    add_overrides,
+    connect,
+    delete_overrides,
+    get_product_overrides,
+    get_product_tree_ids,
+    get_products_state,
+    tree_ids_for_given_arches,
+    product_lock_key,
+    transaction,
+)
+from declarative_config.insert import insert_listing
+from declarative_config.listings import load_listing
+from declarative_config.profiling import query_stats
+from declarative_config.reconcile import (
+    ARCH_TABLE,
+    decode_override,
+    encode_override,
+    expand_package_listings,
+    product_key,
+)
+from declarative_config import memory_db
+
+
+def test_product_lock_key():
+    """Tests that advisory lock keys are stable, fit in a bigint, and differ
+    between products."""
+    key = product_lock_key(["xmlstarlet", 4.5, "Cluster"])
+    assert key == product_lock_key(["xmlstarlet", 4.5, "Cluster"])
+    assert -(2**63) <= key < 2**63
+    assert key != product_lock_key(["xmlstarlet", 4.0, "Cluster"])
+
+
+def test_memory_backend(monkeypatch):
+    """Tests that DB_BACKEND selects the in-memory backend, which applies and
+    generates listings like PostgreSQL would, and rolls back failed
+    transactions."""
+    monkeypatch.setenv("DB_BACKEND", "memory")
+    memory_db.reset()
+    product = ["RHEL-4", 6.0, "AS", False]
+    my_db = connect()
+
+    listing = load_listing("tests/data/listing_5_part1.yaml")
+    prod_id = insert_listing(listing, True, my_db, False)
+    desired = expand_package_listings(listing["packages"])
+    state = get_products_state([product_key(product)], True, my_db, False)
+    assert state[product_key(product)]["overrides"] == desired
+
+    with pytest.raises(RuntimeError):
+        with transaction(True, my_db, False):
+            delete_overrides(desired, prod_id, True, my_db, False)
+            assert not get_product_overrides(prod_id, True, my_db, False)
+            raise RuntimeError("abort")
+    assert len(get_product_overrides(prod_id, True, my_db, False))
+
+    listing = load_listing("tests/data/listing_5_part2.yaml")
+    assert insert_listing(listing, True, my_db, False) == prod_id
+    rows = my_db.query(
+        "select name, pkg_arch, product_arch, product from overrides "
+        "where product in ({0}) order by name".format(prod_id)
+    ).getresult()
+    assert set(rows) == {
+        decode_override(override)[:3] + (prod_id,)
+        for override in expand_package_listings(listing["packages"])
+    }
+
+    with pytest.raises(memory_db.UnsupportedStatement):
+        my_db.query("TRUNCATE overrides")
+    monkeypatch.setenv("DB_BACKEND", "sqlite")
+    with pytest.raises(ValueError):
+        connect()
+
+
+def test_tree_mappings_in_one_statement(monkeypatch):
+    """Tests that inserting a listing looks up the product's tree mappings
+    once and adds the missing ones with a single statement."""
+    monkeypatch.setenv("DB_BACKEND", "memory")
+    memory_db.reset()
+    my_db = connect()
+    listing = load_listing("tests/data/listing_5_part1.yaml")
+    listing["variant"] = "TreeMap"
+    arches = {
+        ARCH_TABLE[key[2]] for key in expand_package_listings(listing["packages"])
+    }
+
+    query_stats.kinds = {}
+    prod_id = insert_listing(listing, True, my_db, False)
+    assert len(query_stats.kinds["tree map lookup"]["latencies"]) == 1
+    assert query_stats.kinds["tree map insert"]["rows"] == len(arches)
+    assert get_product_tree_ids(prod_id, True, my_db, False) == {
+        tree_ids_for_given_arches[arch] for arch in arches
+    }
+
+    query_stats.kinds = {}
+    insert_listing(listing, True, my_db, False, force=True)
+    assert len(query_stats.kinds["tree map lookup"]["latencies"]) == 1
+    assert "tree map insert" not in query_stats.kinds
+
+
+def test_add_overrides_single_statement(caplog):
+    """Tests that new overrides are sent as one multi-row INSERT, which is
+    still printed in dry-run mode."""
+    overrides = {
+        encode_override("xmlstarlet", "src", "x86_64"),
+        encode_override("xmlstarlet", "x86_64", "x86_64"),
+        encode_override("ansible", "noarch", "x86_64"),
+    }
+    with caplog.at_level("INFO"):
+        sent = add_overrides(overrides, 42, False, None, False)
+
+    assert sent == 3
+    statements = [
+        record.message
+        for record in caplog.records
+        if record.message.startswith("Would have executed: INSERT into overrides")
+    ]
+    assert len(statements) == 1
+    assert "('ansible', 'noarch', 'x86_64', 42, 'True')" in statements[0]
+    assert "('xmlstarlet', 'x86_64', 'x86_64', 42, 'True')" in statements[0]
+    assert add_overrides(set(), 42, False, None, False) == 0
+
+
+def test_delete_overrides_single_statement(caplog):
+    """Tests that stale overrides are removed with one set-based DELETE that
+    never matches exclusion overrides, and that the number of removed rows is
+    reported."""
+    overrides = {
+        encode_override("xmlstarlet", "src", "x86_64"),
+        encode_override("xmlstarlet", "x86_64", "x86_64", False),
+    }
+    with caplog.at_level("INFO"):
+        deleted = delete_overrides(overrides, 42, False, None, False)
+
+    assert deleted == 1
+    statements = [
+        record.message
+        for record in caplog.records
+        if record.message.startswith("Would have executed: DELETE from overrides")
+    ]
+    assert len(statements) == 1
+    assert "('xmlstarlet', 'src', 'x86_64')" in statements[0]
+    assert "'x86_64', 'x86_64'" not in statements[0]
+    assert "overrides.include = true" in statements[0]
+    assert "overrides.product = 42" in statements[0]
+    assert "Would have deleted 1 stale overrides for product ID 42." in caplog.text
@@ -1,9 +1,15 @@
 """Testing for declarative config."""
 import argparse
+import json
 import os
+import shutil
+import subprocess
+import sys
 import pytest
 from Levenshtein import distance
 import declarative_config.declarative_config as declarative_config
+from declarative_config.db import connect
+from declarative_config.listings import YamlBadFormat
 
 
 def test_validator_fail():
@@ -14,11 +20,72 @@ def test_validator_fail():
     directory = "tests/data/fail_validation"
 
     for filename in os.listdir(directory):
-        with pytest.raises(declarative_config.YamlBadFormat):
+        with pytest.raises(YamlBadFormat):
             filepath = os.path.join(directory, filename)
             declarative_config.validate_data(parser.parse_args([filepath]))
 
 
+def test_runs_as_module():
+    """Tests that the package runs as python -m declarative_config."""
+    result = subprocess.run(
+        [sys.executable, "-m", "declarative_config", "--help"],
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+    assert result.stdout.startswith("usage: declarative_config ")
+
+
+def test_validate_directory_json_report(tmp_path, capsys):
+    """Tests that validate checks whole directories in parallel and reports
+    every file in one JSON document, exiting non-zero if any failed."""
+    # The fixtures are copied, as other tests write their output to tests/data.
+    listings = tmp_path / "listings"
+    listings.mkdir()
+    for filename in os.listdir("tests/data"):
+        if filename.startswith("listing_"):
+            shutil.copy(os.path.join("tests/data", filename), listings)
+    failing = tmp_path / "fail_validation"
+    shutil.copytree("tests/data/fail_validation", failing)
+
+    with pytest.raises(SystemExit) as excinfo:
+        declarative_config.main(
+            [
+                "validate",
+                str(listings),
+                str(failing),
+                "--jobs",
+                "2",
+                "--json",
+                "--no-cache",
+            ]
+        )
+    assert excinfo.value.code == 1
+
+    report = json.loads(capsys.readouterr().out)
+    assert report["passed"] == len(os.listdir(listings))
+    assert report["failed"] == len(os.listdir(failing))
+    results = {entry["filepath"]: entry for entry in report["files"]}
+    assert results[str(listings / "listing_1.yaml")]["valid"]
+    assert results[str(failing / "multilib_bad_entry.yaml")]["errors"] == {
+        "packages": [
+            {
+                "console-login-helper-messages": [
+                    {"multilib": [{"0": ["must be of dict type"]}]}
+                ]
+            }
+        ]
+    }
+
+
+def test_batch_insert_reports_failures():
+    """Tests that a batch insert of listings that all fail validation exits
+    non-zero without ever connecting to the DB."""
+    with pytest.raises(SystemExit) as excinfo:
+        declarative_config.main(["insert", "tests/data/fail_validation"])
+    assert excinfo.value.code == 1
+
+
 def test_output_same_as_input():
     """Tests that executing the script that puts yaml data into the db,
     followed by executing the script that pulls the data from the db,
@@ -96,7 +163,7 @@ def test_inserted_data_properly_stored_1():
         ]
     )
 
-    my_db = declarative_config.connect()
+    my_db = connect()
 
     # Verify products entry
     query = """select * from products where
@@ -171,7 +238,7 @@ def test_inserted_data_properly_stored_2():
     variant = "Server-RH7-RHOSE-3.5"
     declarative_config.main(["insert", "tests/data/listing_2.yaml", "--commit"])
 
-    my_db = declarative_config.connect()
+    my_db = connect()
 
     # Verify products entry
     query = """select * from products where
@@ -215,7 +282,7 @@ def test_inserted_data_properly_stored_3_no_arch():
     variant = "7Server-Konami"
     declarative_config.main(["insert", "tests/data/listing_3.yaml", "--commit"])
 
-    my_db = declarative_config.connect()
+    my_db = connect()
 
     # Verify products entry
     query = """select * from products where
@@ -258,7 +325,7 @@ def test_inserted_data_properly_stored_4_no_packages():
     variant = "6Server-Konami"
     declarative_config.main(["insert", "tests/data/listing_4.yaml", "--commit"])
 
-    my_db = declarative_config.connect()
+    my_db = connect()
 
     # Verify products entry
     query = """select * from products where
@@ -297,7 +364,7 @@ def test_inserted_data_properly_stored_5_deletions():
     variant = "AS"
     declarative_config.main(["insert", "tests/data/listing_5_part1.yaml", "--commit"])
 
-    my_db = declarative_config.connect()
+    my_db = connect()
 
     # Verify products entry
     query = """select * from products where
@@ -422,7 +489,7 @@ def test_inserted_data_properly_stored_6_complete_package_replacement():
     variant = "Cluster"
     declarative_config.main(["insert", "tests/data/listing_6_part1.yaml", "--commit"])
 
-    my_db = declarative_config.connect()
+    my_db = connect()
 
     # Verify products entry
     query = """select * from products where
@@ -0,0 +1,305 @@
+"""Testing for writing listings from the DB."""
+import json
+import os
+import pytest
+import yaml
+from declarative_config.db import connect
+from declarative_config.declarative_config import main
+from declarative_config.generate import (
+    canonical_listing,
+    fetch_in_batches,
+    listing_filename,
+    listing_from_rows,
+    listing_header,
+    mirror_listings,
+    package_blocks,
+    write_listing,
+    write_listing_blocks,
+)
+from declarative_config.insert import insert_listing
+from declarative_config.listings import load_listing
+from declarative_config.reconcile import compact_rows, expand_package_listings
+from declarative_config import memory_db
+
+
+def test_listing_from_rows_round_trip(tmp_path):
+    """Tests that the overrides rows of a product make up a listing that
+    expands back to the same rows, and that exported listings are named
+    predictably."""
+    listing = load_listing("tests/data/listing_5_part1.yaml")
+    desired = expand_package_listings(listing["packages"])
+    product = (3, "RHEL-4", "6.0", "AS", False)
+
+    yaml_data = listing_from_rows(product, sorted(desired))
+    assert yaml_data["product_name"] == "RHEL-4"
+    assert yaml_data["version"] == 6.0
+    assert expand_package_listings(yaml_data["packages"]) == (desired)
+    assert "packages" not in listing_from_rows(product, [])
+
+    filepath = tmp_path / listing_filename("RHEL-4", "6.0", "AS")
+    write_listing(yaml_data, filepath)
+    assert filepath.name == "RHEL-4_6.0_AS.yaml"
+    assert load_listing(filepath) == yaml_data
+    assert (
+        listing_filename("RHEL 7/OSE", "3.5", "Server") == "RHEL_7_OSE_3.5_Server.yaml"
+    )
+
+
+def test_streamed_listing_matches_bulk(tmp_path):
+    """Tests that writing a listing one package block at a time, from rows
+    fetched through a cursor in batches, gives the same file as dumping it
+    whole."""
+    listing = load_listing("tests/data/listing_6_part1.yaml")
+    rows = sorted(expand_package_listings(listing["packages"]))
+    product = (3, "RHEL-4", "6.0", "AS", False)
+
+    class CursorDB:
+        """Serves FETCH queries from rows, recording the statements sent."""
+
+        def __init__(self):
+            self.queries = []
+            self.position = 0
+
+        def query(self, query):
+            """Records a statement, returning itself for getresult()."""
+            self.queries.append(query)
+            return self
+
+        def getresult(self):
+            """Returns the next batch of rows."""
+            batch = rows[self.position : self.position + 2]
+            self.position += 2
+            return batch
+
+    my_db = CursorDB()
+    streamed = tmp_path / "streamed.yaml"
+    with open(streamed, "w", encoding="ascii") as yaml_file:
+        packages = write_listing_blocks(
+            listing_header(product),
+            package_blocks(fetch_in_batches(my_db, "select 1", 2)),
+            yaml_file,
+        )
+    assert packages == len({row[0] for row in rows})
+    assert my_db.queries[0] == "BEGIN"
+    assert my_db.queries[1].startswith("DECLARE generate_overrides")
+    assert my_db.queries[-1] == "ROLLBACK"
+    assert my_db.queries.count("FETCH FORWARD 2 FROM generate_overrides") == (
+        (len(rows) + 1) // 2 + 1
+    )
+
+    bulk = tmp_path / "bulk.yaml"
+    write_listing(listing_from_rows(product, rows), bulk)
+    assert streamed.read_text() == bulk.read_text()
+
+
+def test_mirror_listings_incremental(tmp_path):
+    """Tests that exporting into a directory again only rewrites listings whose
+    rows changed, regardless of row order, and removes listings that are
+    gone."""
+    first = (1, "RHEL-4", "6.0", "AS", False)
+    second = (2, "RHEL-5", "7.0", "ES", False)
+    rows = list(
+        compact_rows([("pkg", "src", "x86_64", 1), ("pkg", "x86_64", "x86_64", 1)])
+    )
+    listings = {"first.yaml": (first, rows), "second.yaml": (second, [])}
+
+    assert mirror_listings(listings, tmp_path) == (2, 0)
+    assert json.loads((tmp_path / ".manifest.json").read_text()).keys() == {
+        "first.yaml",
+        "second.yaml",
+    }
+
+    listings["first.yaml"] = (first, list(reversed(rows)))
+    assert mirror_listings(listings, tmp_path) == (0, 0)
+    assert mirror_listings(listings, tmp_path, full=True) == (
+        2,
+        0,
+    )
+
+    (tmp_path / "unrelated.yaml").write_text("---\n")
+    listings["first.yaml"] = (first, rows[:1])
+    del listings["second.yaml"]
+    assert mirror_listings(listings, tmp_path) == (1, 1)
+    assert sorted(path.name for path in tmp_path.iterdir()) == [
+        ".manifest.json",
+        "first.yaml",
+        "unrelated.yaml",
+    ]
+    assert "x86_64" not in load_listing(tmp_path / "first.yaml")["packages"]["pkg"].get(
+        "arch", []
+    )
+
+
+def test_canonical_listing_is_deterministic(tmp_path):
+    """Tests that the same rows returned in any order dump to the same bytes
+    in canonical mode, with packages and arches sorted."""
+    listing = load_listing("tests/data/listing_6_part1.yaml")
+    rows = sorted(expand_package_listings(listing["packages"]))
+    product = (3, "RHEL-4", "6.0", "AS", False)
+
+    dumps = []
+    for ordering in (rows, list(reversed(rows)), rows[1::2] + rows[::2]):
+        filepath = tmp_path / "listing.yaml"
+        write_listing(
+            canonical_listing(listing_from_rows(product, ordering)),
+            filepath,
+        )
+        dumps.append(filepath.read_bytes())
+    assert dumps[0] == dumps[1] == dumps[2]
+
+    packages = load_listing(filepath)["packages"]
+    assert list(packages) == sorted(packages)
+    offerings = packages["console-login-helper-messages"]
+    assert list(offerings) == ["arch", "src", "noarch", "multilib"]
+    assert offerings["arch"] == sorted(offerings["arch"])
+    assert offerings["multilib"] == sorted(
+        offerings["multilib"], key=lambda entry: list(entry.items())
+    )
+
+
+def test_generate_all(tmp_path, monkeypatch, caplog):
+    """Tests that generate --all writes every listing in the DB to its own file
+    along with the manifest, and that exporting again rewrites nothing."""
+    monkeypatch.setenv("DB_BACKEND", "memory")
+    memory_db.reset()
+    listings = {}
+    for number, variant in (("5_part1", "ExportA"), ("6_part1", "ExportB")):
+        listing = load_listing("tests/data/listing_{0}.yaml".format(number))
+        listing["variant"] = variant
+        listing_path = str(tmp_path / (variant + ".yaml"))
+        write_listing(listing, listing_path)
+        main(["insert", listing_path, "--commit"])
+        filename = listing_filename(
+            listing["product_name"], listing["version"], variant
+        )
+        listings[filename] = listing
+
+    exported = tmp_path / "exported"
+    main(["generate", str(exported), "--all"])
+    assert sorted(os.listdir(exported)) == sorted([".manifest.json"] + list(listings))
+    assert json.loads((exported / ".manifest.json").read_text()).keys() == set(listings)
+    for filename, listing in listings.items():
+        generated = load_listing(exported / filename)
+        assert generated["variant"] == listing["variant"]
+        assert expand_package_listings(
+            generated["packages"]
+        ) == expand_package_listings(listing["packages"])
+
+    caplog.clear()
+    with caplog.at_level("INFO"):
+        main(["generate", str(exported), "--all"])
+    assert "0 written, 2 unchanged, 0 removed" in caplog.text
+
+
+def test_failed_generate_all_closes_db(tmp_path, monkeypatch):
+    """Tests that generate --all closes its connection when reading the DB
+    fails."""
+    monkeypatch.setenv("DB_BACKEND", "memory")
+    memory_db.reset()
+
+    def failing_read(query, _my_db, _kind):
+        raise RuntimeError("Lost the connection running " + query)
+
+    closed = []
+    monkeypatch.setattr("declarative_config.generate.read_query", failing_read)
+    monkeypatch.setattr(memory_db.MemoryDB, "close", lambda self: closed.append(1))
+    with pytest.raises(SystemExit) as exit_info:
+        main(["generate", str(tmp_path / "exported"), "--all"])
+    assert exit_info.value.code == 1
+    assert len(closed) == 1
+
+
+def test_generate_canonical(tmp_path, monkeypatch):
+    """Tests that generate --canonical writes a listing's packages and arches
+    in sorted order, however small the batches its rows are fetched in."""
+    monkeypatch.setenv("DB_BACKEND", "memory")
+    memory_db.reset()
+    listing = load_listing("tests/data/listing_6_part1.yaml")
+    listing["variant"] = "Canonical"
+    listing_path = str(tmp_path / "listing.yaml")
+    write_listing(listing, listing_path)
+    main(["insert", listing_path, "--commit"])
+
+    dumps = []
+    for batch_size in ("1", "5000"):
+        filepath = tmp_path / "canonical_{0}.yaml".format(batch_size)
+        main(
+            [
+                "generate",
+                str(filepath),
+                "--canonical",
+                "--batch-size",
+                batch_size,
+                "--product",
+                listing["product_name"],
+                "--version",
+                str(listing["version"]),
+                "--variant",
+                "Canonical",
+            ]
+        )
+        dumps.append(filepath.read_bytes())
+    assert dumps[0] == dumps[1]
+
+    packages = load_listing(filepath)["packages"]
+    assert list(packages) == sorted(packages)
+    for offerings in packages.values():
+        for arches in offerings.values():
+            if arches and isinstance(arches[0], str):
+                assert arches == sorted(arches)
+    assert list(packages["console-login-helper-messages"]) == [
+        "arch",
+        "src",
+        "noarch",
+        "multilib",
+    ]
+    assert expand_package_listings(packages) == expand_package_listings(
+        listing["packages"]
+    )
+
+
+def test_failed_generate_cleans_up(tmp_path, monkeypatch):
+    """Tests that a generate failing half way through writing removes the
+    partial file, leaves no listing behind and closes its connection."""
+    monkeypatch.setenv("DB_BACKEND", "memory")
+    memory_db.reset()
+    my_db = connect()
+    listing = load_listing("tests/data/listing_5_part1.yaml")
+    insert_listing(listing, True, my_db, False)
+
+    def failing_write(header, blocks, yaml_file):
+        """Writes the header, then fails like a full disk would."""
+        yaml_file.write(yaml.safe_dump(header))
+        next(iter(blocks))
+        raise OSError("No space left on device")
+
+    closed = []
+    close = memory_db.MemoryDB.close
+
+    def recording_close(self):
+        """Records that a connection was closed before closing it."""
+        closed.append(self)
+        close(self)
+
+    monkeypatch.setattr(
+        "declarative_config.generate.write_listing_blocks", failing_write
+    )
+    monkeypatch.setattr(memory_db.MemoryDB, "close", recording_close)
+    filepath = tmp_path / "listing.yaml"
+    with pytest.raises(SystemExit) as exit_info:
+        main(
+            [
+                "generate",
+                str(filepath),
+                "--product",
+                "RHEL-4",
+                "--version",
+                "6.0",
+                "--variant",
+                "AS",
+            ]
+        )
+    assert exit_info.value.code == 1
+    assert not os.listdir(tmp_path)
+    assert len(closed) == 1
+    assert "generate_overrides" not in closed[0]._cursors
@@ -0,0 +1,103 @@
+"""Testing for applying listings to the DB."""
+import pytest
+from declarative_config.db import (
+    add_overrides,
+    connect,
+    get_product_overrides,
+    get_products_state,
+)
+from declarative_config.declarative_config import main
+from declarative_config.generate import write_listing
+from declarative_config.insert import insert_listing
+from declarative_config.listings import expand_listing_paths, load_listing
+from declarative_config.reconcile import (
+    encode_override,
+    expand_package_listings,
+    product_key,
+)
+from declarative_config import memory_db
+
+
+def test_parallel_batch_insert_reports_in_order(caplog):
+    """Tests that a batch applied by several workers reports its results in
+    the order the files were given."""
+    directory = "tests/data/fail_validation"
+    with caplog.at_level("INFO"), pytest.raises(SystemExit) as excinfo:
+        main(["insert", directory, "--jobs", "3"])
+    assert excinfo.value.code == 1
+
+    failed = [
+        record.message
+        for record in caplog.records
+        if record.message.startswith("FAILED")
+    ]
+    assert failed == [
+        "FAILED {0}: failed schema validation".format(filepath)
+        for filepath in expand_listing_paths([directory])
+    ]
+
+
+def test_exclusion_overrides_survive_insert(monkeypatch):
+    """Tests that re-inserting a listing leaves the product's exclusion
+    overrides (include false) in place, since a listing can't express them."""
+    monkeypatch.setenv("DB_BACKEND", "memory")
+    memory_db.reset()
+    my_db = connect()
+
+    # A variant of its own keeps the exclusion away from the other tests'
+    # products in the shared store.
+    listing = load_listing("tests/data/listing_5_part1.yaml")
+    listing["variant"] = "Exclusions"
+    prod_id = insert_listing(listing, True, my_db, False)
+    excluded = encode_override("xmlstarlet", "ppc", "ppc64", False)
+    add_overrides({excluded}, prod_id, True, my_db, False)
+
+    listing = load_listing("tests/data/listing_5_part2.yaml")
+    listing["variant"] = "Exclusions"
+    insert_listing(listing, True, my_db, False, force=True)
+    overrides = get_product_overrides(prod_id, True, my_db, False)
+    assert excluded in overrides
+    assert overrides == expand_package_listings(listing["packages"]) | {excluded}
+
+
+def test_listed_exclusion_is_not_inserted(monkeypatch):
+    """Tests that a listing key the DB holds an exclusion override for is left
+    alone, rather than inserted next to the exclusion."""
+    monkeypatch.setenv("DB_BACKEND", "memory")
+    memory_db.reset()
+    my_db = connect()
+
+    listing = load_listing("tests/data/listing_5_part1.yaml")
+    listing["variant"] = "ListedExclusion"
+    prod_id = insert_listing(listing, True, my_db, False)
+    excluded = encode_override("xmlstarlet", "ia64", "ia64", False)
+    add_overrides({excluded}, prod_id, True, my_db, False)
+
+    # The new listing offers xmlstarlet for ia64, which the DB excludes.
+    listing = load_listing("tests/data/listing_5_part2.yaml")
+    listing["variant"] = "ListedExclusion"
+    assert excluded[:3] + (True,) in expand_package_listings(listing["packages"])
+    insert_listing(listing, True, my_db, False, force=True)
+    overrides = get_product_overrides(prod_id, True, my_db, False)
+    assert {key for key in overrides if key[:3] == excluded[:3]} == {excluded}
+    assert len(overrides) == len(expand_package_listings(listing["packages"]))
+
+
+def test_memory_backend_applies_jobs_serially(tmp_path, monkeypatch, caplog):
+    """Tests that --jobs falls back to applying listings one at a time with
+    the memory backend, whose workers couldn't share the DB."""
+    monkeypatch.setenv("DB_BACKEND", "memory")
+    memory_db.reset()
+    keys = []
+    for variant in ("JobsA", "JobsB"):
+        listing = load_listing("tests/data/listing_5_part1.yaml")
+        listing["variant"] = variant
+        write_listing(listing, tmp_path / (variant + ".yaml"))
+        keys.append(
+            product_key([listing["product_name"], listing["version"], variant, False])
+        )
+
+    with caplog.at_level("WARNING"):
+        main(["insert", str(tmp_path), "--commit", "--jobs", "2"])
+    assert "Applying the listings one at a time" in caplog.text
+    assert sorted(get_products_state(keys, True, connect(), False)) == sorted(keys)
@@ -0,0 +1,116 @@
+"""Testing for loading and validating listings."""
+import os
+import shutil
+import time
+import yaml
+from declarative_config.declarative_config import main
+from declarative_config.generate import YamlDumper
+from declarative_config.listings import (
+    ValidationCache,
+    YamlLoader,
+    expand_listing_paths,
+    load_validator,
+)
+
+
+def test_validation_cache(tmp_path):
+    """Tests that listings that passed are remembered by content, that a
+    schema change forgets them, that the cache stays within its size, and that
+    the directories of other schemas are only removed once unused."""
+    schemapath = tmp_path / "yaml_schema.yaml"
+    shutil.copy("yaml_schema.yaml", schemapath)
+    cache_dir = str(tmp_path / "cache")
+    with open("tests/data/listing_1.yaml", "rb") as yaml_file:
+        content = yaml_file.read()
+
+    cache = ValidationCache(cache_dir, str(schemapath), "fast")
+    assert not cache.is_known_good(content)
+    main(
+        [
+            "validate",
+            "tests/data",
+            "--schemapath",
+            str(schemapath),
+            "--cache-dir",
+            cache_dir,
+        ]
+    )
+    assert cache.is_known_good(content)
+    assert not cache.is_known_good(content + b"\n")
+
+    with open(schemapath, "a", encoding="ascii") as schema_file:
+        schema_file.write("\n")
+    changed = ValidationCache(cache_dir, str(schemapath), "fast")
+    assert not changed.is_known_good(content)
+    changed.remember(content)
+    changed.remember(content + b"\n")
+    changed.prune(max_entries=1)
+    assert len(os.listdir(changed.path)) == 1
+    assert sorted(os.listdir(cache_dir)) == sorted(
+        [os.path.basename(cache.path), os.path.basename(changed.path)]
+    )
+    assert cache.is_known_good(content)
+
+    # The old schema's directory goes once it was unused for long enough, but
+    # the directory in use and anything that isn't a cache directory stay.
+    os.mkdir(os.path.join(cache_dir, "unrelated"))
+    long_ago = time.time() - 60 * 24 * 60 * 60
+    for path in [cache.path] + [
+        os.path.join(cache.path, name) for name in os.listdir(cache.path)
+    ]:
+        os.utime(path, (long_ago, long_ago))
+    changed.prune(max_entries=1, max_age=24 * 60 * 60)
+    assert sorted(os.listdir(cache_dir)) == sorted(
+        [os.path.basename(changed.path), "unrelated"]
+    )
+    os.utime(changed.path, (long_ago, long_ago))
+    changed.prune(max_age=0)
+    assert os.path.isdir(changed.path)
+
+
+def test_expand_listing_paths():
+    """Tests that directories and globs given to insert expand to the listing
+    files they contain, in a predictable order."""
+    expanded = expand_listing_paths(
+        ["tests/data", "tests/data/listing_5_part*.yaml", "missing.yaml"]
+    )
+    directory_files = sorted(
+        os.path.join("tests/data", filename)
+        for filename in os.listdir("tests/data")
+        if filename.endswith(".yaml")
+    )
+    assert expanded == directory_files + [
+        "tests/data/listing_5_part1.yaml",
+        "tests/data/listing_5_part2.yaml",
+        "missing.yaml",
+    ]
+
+
+def test_validator_cached_until_schema_changes(tmp_path):
+    """Tests that the schema is compiled once and only reloaded when the
+    schema file changes."""
+    schemapath = tmp_path / "yaml_schema.yaml"
+    shutil.copy("yaml_schema.yaml", schemapath)
+
+    validator = load_validator(str(schemapath))
+    assert load_validator(str(schemapath)) is validator
+
+    stat = os.stat(schemapath)
+    os.utime(schemapath, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000))
+    assert load_validator(str(schemapath)) is not validator
+
+
+def test_fast_yaml_matches_pure_python():
+    """Tests that the libyaml-backed loader and dumper, when available, read and
+    write listings exactly like the pure Python ones."""
+    for filename in sorted(os.listdir("tests/data")):
+        if not filename.endswith(".yaml"):
+            continue
+        with open(os.path.join("tests/data", filename), encoding="ascii") as file:
+            text = file.read()
+
+        data = yaml.load(text, Loader=YamlLoader)
+        assert data == yaml.load(text, Loader=yaml.FullLoader)
+        assert yaml.dump(data, Dumper=YamlDumper, sort_keys=False) == yaml.dump(
+            data, sort_keys=False
+        )
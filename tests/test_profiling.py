@@ -0,0 +1,142 @@
+"""Testing for the query stats and profiling of runs."""
+import io
+import json
+import pstats
+import time
+from declarative_config.db import (
+    add_overrides_statement,
+    add_tree_product_mappings_statement,
+    connect,
+    delete_overrides_statement,
+    resolve_product_statement,
+    store_listing_fingerprint_statement,
+)
+from declarative_config.declarative_config import main
+from declarative_config.insert import insert_listing
+from declarative_config.listings import load_listing
+from declarative_config.profiling import (
+    PhaseTimer,
+    QueryStats,
+    phase_timer,
+    query_stats,
+    statement_kind,
+)
+from declarative_config.reconcile import encode_override, expand_package_listings
+from declarative_config import memory_db
+
+
+def test_query_stats_by_statement_kind():
+    """Tests that statements are grouped by kind, and that the summary reports
+    counts, rows and nearest-rank latency percentiles as a table or JSON."""
+    product = ["RHEL-4", 6.0, "AS", False]
+    overrides = {encode_override("xmlstarlet", "src", "x86_64")}
+    kinds = {
+        "BEGIN": "transaction",
+        "SELECT name, pkg_arch, product_arch, include FROM overrides\n"
+        "    WHERE product = '3'": "override lookup",
+        "SELECT pg_try_advisory_xact_lock(1) AS locked": "product lock",
+        resolve_product_statement(product): "product lookup",
+        add_overrides_statement(overrides, 3): "override insert",
+        delete_overrides_statement(overrides, 3): ("override delete"),
+        add_tree_product_mappings_statement([5558], 3): ("tree map insert"),
+        store_listing_fingerprint_statement(3, "ab"): ("fingerprint store"),
+        "VACUUM": "other",
+    }
+    for query, kind in kinds.items():
+        assert statement_kind(query) == kind
+
+    stats = QueryStats()
+    for millis in range(1, 101):
+        stats.record("override insert", millis / 1000, 2)
+    stats.merge({"transaction": {"latencies": [0.5], "rows": 0}})
+    summary = stats.summary()
+    assert list(summary) == ["override insert", "transaction"]
+    assert summary["override insert"]["count"] == 100
+    assert summary["override insert"]["rows"] == 200
+    assert summary["override insert"]["p50_ms"] == 50
+    assert summary["override insert"]["p95_ms"] == 95
+    assert summary["override insert"]["max_ms"] == 100
+
+    table = io.StringIO()
+    stats.report("table", table)
+    assert table.getvalue().splitlines()[1].startswith("override insert")
+    as_json = io.StringIO()
+    stats.report("json", as_json)
+    assert json.loads(as_json.getvalue()) == summary
+
+
+def test_generate_query_stats(tmp_path, monkeypatch, capsys):
+    """Tests that --stats reports the statements generate reads the listing
+    with, including each batch fetched through its cursor."""
+    monkeypatch.setenv("DB_BACKEND", "memory")
+    memory_db.reset()
+    listing = load_listing("tests/data/listing_5_part1.yaml")
+    listing["variant"] = "Stats"
+    insert_listing(listing, True, connect(), False)
+    overrides = len(expand_package_listings(listing["packages"]))
+
+    query_stats.kinds = {}
+    main(
+        [
+            "--stats",
+            "json",
+            "generate",
+            str(tmp_path / "listing.yaml"),
+            "--batch-size",
+            "2",
+            "--version",
+            "6.0",
+            "--product",
+            "RHEL-4",
+            "--variant",
+            "Stats",
+        ]
+    )
+    summary = json.loads(capsys.readouterr().err)
+    assert summary["generate lookup"]["count"] == 1
+    # BEGIN, DECLARE, a FETCH per batch and the empty one, then ROLLBACK.
+    assert summary["generate fetch"]["count"] == 2 + (overrides + 1) // 2 + 1 + 1
+    assert summary["generate fetch"]["rows"] == overrides
+
+
+def test_profile_reports_phases(tmp_path, capsys):
+    """Tests that nested phases are timed exclusively, and that --profile
+    writes a pstats or collapsed-stack profile of the command along with the
+    wall time of each phase."""
+    timer = PhaseTimer()
+    with timer.phase("write"):
+        with timer.phase("read"):
+            time.sleep(0.02)
+    assert timer.totals["read"] >= 0.02
+    assert timer.totals["write"] < 0.02
+
+    for profile_format in ("pstats", "collapsed"):
+        phase_timer.totals = {}
+        profile = tmp_path / "profile.{0}".format(profile_format)
+        main(
+            [
+                "--profile",
+                str(profile),
+                "--profile-format",
+                profile_format,
+                "validate",
+                "tests/data/listing_1.yaml",
+                "--no-cache",
+                "-j",
+                "1",
+            ]
+        )
+        report = json.loads(capsys.readouterr().err)
+        assert report["profile"] == str(profile)
+        assert set(report["phases"]) == {"load", "validate"}
+        assert report["wall_seconds"] >= sum(report["phases"].values())
+
+    stats = pstats.Stats(str(tmp_path / "profile.pstats"))
+    assert any(func[2] == "validate_listings" for func in stats.stats)
+    stacks = (tmp_path / "profile.collapsed").read_text().splitlines()
+    assert all(line.rpartition(" ")[2].isdigit() for line in stacks)
+    assert any(
+        line.startswith("validate_listings (declarative_config.py:")
+        and "validate_listing_file" in line
+        for line in stacks
+    )
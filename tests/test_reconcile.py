@@ -0,0 +1,103 @@
+"""Testing for reconciling listings against the DB."""
+import sys
+import yaml
+from declarative_config.generate import listing_from_rows
+from declarative_config.listings import load_listing
+from declarative_config.reconcile import (
+    ARCH_CODES,
+    ARCH_TABLE,
+    arch_code,
+    compact_rows,
+    decode_override,
+    encode_override,
+    expand_package_listings,
+    listing_fingerprint,
+    normalize_overrides,
+    reconcile_overrides,
+)
+
+
+def test_reconcile_overrides():
+    """Tests that the set-based reconciliation splits a listing update into
+    the right inserts, deletions and untouched overrides, without the DB."""
+    with open("tests/data/listing_5_part1.yaml", encoding="ascii") as yaml_file:
+        part1 = yaml.load(yaml_file, Loader=yaml.FullLoader)
+    with open("tests/data/listing_5_part2.yaml", encoding="ascii") as yaml_file:
+        part2 = yaml.load(yaml_file, Loader=yaml.FullLoader)
+
+    current = expand_package_listings(part1["packages"])
+    desired = expand_package_listings(part2["packages"])
+    assert len(current) == 16
+    assert len(desired) == 12
+
+    changes = reconcile_overrides(desired, current)
+    assert changes.to_insert == {
+        encode_override("xmlstarlet", "ia64", "ia64"),
+        encode_override("xmlstarlet", "src", "ia64"),
+    }
+    assert encode_override("console-login-helper-messages", "noarch", "ppc64le") in (
+        changes.to_delete
+    )
+    assert len(changes.to_delete) == 6
+    assert len(changes.unchanged) == 10
+
+    # Rows as they come back from the DB normalize to the same keys
+    rows = [
+        (name, pkg_arch, prod_arch, include, 1)
+        for name, pkg_arch, prod_arch, include in map(decode_override, current)
+    ]
+    assert normalize_overrides(rows) == current
+
+
+def test_compact_overrides():
+    """Tests that overrides are keyed by interned package names and arch codes
+    that sort like the arch names, and decode back to the DB values."""
+    override = encode_override("".join(["xml", "starlet"]), "src", "x86_64")
+    assert override == (
+        "xmlstarlet",
+        ARCH_CODES["src"],
+        ARCH_CODES["x86_64"],
+        True,
+    )
+    assert override[0] is sys.intern("xmlstarlet")
+    assert decode_override(override) == (
+        "xmlstarlet",
+        "src",
+        "x86_64",
+        True,
+    )
+    assert ARCH_TABLE == sorted(ARCH_TABLE)
+
+    # Arches outside the table get a code of their own the first time they appear
+    code = arch_code("riscv64")
+    assert ARCH_TABLE[code] == "riscv64"
+    assert arch_code("riscv64") == code
+
+    rows = [("xmlstarlet", "src", "x86_64", 3), ("xmlstarlet", "x86_64", "x86_64", 3)]
+    compact = list(compact_rows(rows))
+    assert compact[0] == override[:3]
+    assert listing_from_rows((3, "RHEL-4", "6.0", "AS", False), compact)[
+        "packages"
+    ] == {"xmlstarlet": {"src": ["x86_64"], "arch": ["x86_64"]}}
+
+
+def test_listing_fingerprint():
+    """Tests that the listing fingerprint ignores ordering in the yaml file but
+    changes with the product or its overrides."""
+    product = ["RHEL-4", 6.0, "AS", False]
+    part1 = load_listing("tests/data/listing_5_part1.yaml")
+    part2 = load_listing("tests/data/listing_5_part2.yaml")
+    desired = expand_package_listings(part1["packages"])
+
+    reordered = {
+        name: {kind: list(reversed(arches)) for kind, arches in offerings.items()}
+        for name, offerings in reversed(list(part1["packages"].items()))
+    }
+    fingerprint = listing_fingerprint(product, desired)
+    assert fingerprint == listing_fingerprint(
+        product, expand_package_listings(reordered)
+    )
+    assert fingerprint != listing_fingerprint(
+        product, expand_package_listings(part2["packages"])
+    )
+    assert fingerprint != listing_fingerprint(["RHEL-4", 6.0, "AS", True], desired)
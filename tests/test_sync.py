@@ -0,0 +1,132 @@
+"""Testing for syncing the listings of a git checkout."""
+import os
+import shutil
+import subprocess
+import pytest
+from declarative_config.db import connect, get_last_synced_commit
+from declarative_config.declarative_config import main
+from declarative_config.generate import write_listing
+from declarative_config.insert import apply_listing_files
+from declarative_config.listings import load_listing
+from declarative_config.sync import changed_listings
+from declarative_config import memory_db
+
+
+def test_changed_listings(tmp_path):
+    """Tests that the git-aware sync picks up the listings that were added,
+    modified, renamed or deleted between two commits, and nothing else."""
+
+    def git(*args):
+        subprocess.run(
+            ["git", "-C", str(tmp_path), "-c", "user.name=test"]
+            + ["-c", "user.email=test@example.com"]
+            + list(args),
+            check=True,
+            capture_output=True,
+        )
+
+    listings = tmp_path / "listings"
+    listings.mkdir()
+    for number in ("1", "2", "3"):
+        shutil.copy("tests/data/listing_{0}.yaml".format(number), listings)
+    git("init")
+    git("add", ".")
+    git("commit", "-m", "first")
+    first = subprocess.run(
+        ["git", "-C", str(tmp_path), "rev-parse", "HEAD"],
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout.strip()
+
+    with open(listings / "listing_1.yaml", "a", encoding="ascii") as yaml_file:
+        yaml_file.write("# changed\n")
+    git("mv", "listings/listing_2.yaml", "listings/renamed.yaml")
+    shutil.copy("tests/data/listing_4.yaml", listings)
+    (tmp_path / "README").write_text("not a listing\n")
+    git("add", ".")
+    git("commit", "-m", "second")
+
+    changed, deleted = changed_listings(str(listings), first)
+    assert changed == [
+        os.path.join(str(listings), "listing_1.yaml"),
+        os.path.join(str(listings), "listing_4.yaml"),
+        os.path.join(str(listings), "renamed.yaml"),
+    ]
+    assert deleted == [os.path.join(str(listings), "listing_2.yaml")]
+
+
+def test_sync_records_commit(tmp_path, monkeypatch):
+    """Tests that sync records the commit it applied a checkout at, applies
+    only the listings changed since then on the next run, leaves the
+    recorded commit alone when a listing fails, and refuses a checkout with
+    uncommitted changes."""
+    monkeypatch.setenv("DB_BACKEND", "memory")
+    memory_db.reset()
+
+    def git(*args):
+        return subprocess.run(
+            ["git", "-C", str(tmp_path), "-c", "user.name=test"]
+            + ["-c", "user.email=test@example.com"]
+            + list(args),
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout.strip()
+
+    applied = []
+    apply_files = apply_listing_files
+
+    def recording_apply(filepaths, options):
+        """Records which listings a sync applied before applying them."""
+        applied.append(sorted(os.path.basename(path) for path in filepaths))
+        return apply_files(filepaths, options)
+
+    monkeypatch.setattr("declarative_config.sync.apply_listing_files", recording_apply)
+
+    # Variants of their own keep the synced products away from the other
+    # tests' products in the shared store.
+    listings = tmp_path / "listings"
+    listings.mkdir()
+    for number, variant in (("5_part1", "SyncA"), ("6_part1", "SyncB")):
+        listing = load_listing("tests/data/listing_{0}.yaml".format(number))
+        listing["variant"] = variant
+        write_listing(listing, listings / (variant + ".yaml"))
+    git("init")
+    git("add", ".")
+    git("commit", "-m", "first")
+
+    def last_synced():
+        return get_last_synced_commit("listings/", True, connect(), False)
+
+    main(["sync", str(listings), "--commit"])
+    assert applied == [["SyncA.yaml", "SyncB.yaml"]]
+    assert last_synced() == git("rev-parse", "HEAD")
+
+    with open(listings / "SyncA.yaml", "a", encoding="ascii") as yaml_file:
+        yaml_file.write("# changed\n")
+    git("commit", "-am", "second")
+    main(["sync", str(listings), "--commit"])
+    assert applied[1] == ["SyncA.yaml"]
+    second = git("rev-parse", "HEAD")
+    assert last_synced() == second
+
+    shutil.copy(
+        "tests/data/fail_validation/bad_package_arch.yaml", listings / "bad.yaml"
+    )
+    git("add", ".")
+    git("commit", "-m", "third")
+    with pytest.raises(SystemExit) as excinfo:
+        main(["sync", str(listings), "--commit"])
+    assert excinfo.value.code == 1
+    assert applied[2] == ["bad.yaml"]
+    assert last_synced() == second
+
+    os.remove(listings / "bad.yaml")
+    with open(listings / "SyncB.yaml", "a", encoding="ascii") as yaml_file:
+        yaml_file.write("# not committed\n")
+    with pytest.raises(SystemExit) as excinfo:
+        main(["sync", str(listings), "--commit"])
+    assert excinfo.value.code == 1
+    assert len(applied) == 3
+    assert last_synced() == second
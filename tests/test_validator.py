@@ -0,0 +1,47 @@
+"""Testing for the compiled listing validator."""
+from declarative_config.listings import (
+    expand_listing_paths,
+    load_listing,
+    load_validator,
+)
+from declarative_config.validator import ListingValidator
+
+
+def test_fast_validator_matches_cerberus():
+    """Tests that the compiled listing validator passes and fails the same
+    listings as Cerberus, with the same error structure."""
+    fast = load_validator("yaml_schema.yaml", "fast")
+    cerberus = load_validator("yaml_schema.yaml", "cerberus")
+    assert isinstance(fast, ListingValidator)
+
+    directories = ["tests/data", "tests/data/fail_validation"]
+    for filepath in expand_listing_paths(directories):
+        data = load_listing(filepath)
+        assert fast.validate(data) == cerberus.validate(data)
+        assert fast.errors == cerberus.errors
+
+    data = {
+        "product_name": "name",
+        "version": 200,
+        "allow_source_only": None,
+        "packages": {
+            "Bad_Name": {"arch": ["zzz"], "unknown": []},
+            "noarch-types": {"noarch": [5, None, "x86_64"]},
+            "multilib": {"multilib": [{"bad": "bad"}, {"i386": 5}, "not a dict"]},
+        },
+    }
+    assert not fast.validate(data)
+    assert not cerberus.validate(data)
+    assert fast.errors == cerberus.errors
+
+    # Only the last name of an arch regex is anchored at the end.
+    for arch in ("s390xyz", "i386-extra", "x86_64", "x86_64\n", "x86_64z", "ppc6"):
+        data = {
+            "product_name": "name",
+            "version": 1.0,
+            "variant": "variant",
+            "allow_source_only": False,
+            "packages": {"pkg": {"arch": [arch]}},
+        }
+        assert fast.validate(data) == cerberus.validate(data), arch
+        assert fast.errors == cerberus.errors